@@ -0,0 +1,75 @@
+"""Compare CPU time per listener of the chunk fan-out strategies.
+
+Run from the repository root:
+
+    python benchmarks/fanout.py [listeners] [chunks]
+"""
+from os.path import dirname, abspath
+from resource import getrusage, RUSAGE_SELF
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+
+from txplaya.player import ListenerRegistry
+
+CHUNK = 'x' * 5000
+
+
+class NullListener(object):
+
+    def __init__(self):
+        self.written = 0
+
+    def onPush(self, buf):
+        self.written = self.written + len(buf)
+
+
+def cpuTime():
+    usage = getrusage(RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def benchDeferPerListener(listeners, chunks):
+    for _ in xrange(chunks):
+        for listener in listeners:
+            deferLater(reactor, 0, listener.onPush, CHUNK)
+        reactor.runUntilCurrent()
+
+
+def benchBroadcast(listeners, chunks):
+    registry = ListenerRegistry(batch=True)
+    for listener in listeners:
+        registry.add(listener)
+
+    for _ in xrange(chunks):
+        registry.broadcast(CHUNK)
+        reactor.runUntilCurrent()
+
+
+def run(name, bench, listenerCount, chunks):
+    listeners = [NullListener() for _ in xrange(listenerCount)]
+
+    start = cpuTime()
+    bench(listeners, chunks)
+    elapsed = cpuTime() - start
+
+    assert all(listener.written == len(CHUNK) * chunks for listener in listeners)
+
+    perListener = elapsed * 1e6 / (listenerCount * chunks)
+    print '%-20s %8.3f s total %8.2f us per listener per chunk' % (name, elapsed, perListener)
+
+
+def main():
+    listenerCount = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    chunks = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+
+    print '%d listeners, %d chunks (%d s of audio)' % (listenerCount, chunks, chunks / 5)
+    run('deferLater/listener', benchDeferPerListener, listenerCount, chunks)
+    run('broadcast', benchBroadcast, listenerCount, chunks)
+
+
+if __name__ == '__main__':
+    main()
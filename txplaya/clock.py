@@ -0,0 +1,38 @@
+import ctypes
+import ctypes.util
+from time import time
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+_CLOCK_MONOTONIC = 1
+
+
+def _getMonotonic():
+    try:
+        from time import monotonic as monotonic_
+        return monotonic_
+    except ImportError:
+        pass
+
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        clockGettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        # no monotonic clock available, wall clock will do
+        return time
+
+    clockGettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+    def monotonic_():
+        ts = _Timespec()
+        if clockGettime(_CLOCK_MONOTONIC, ctypes.pointer(ts)) != 0:
+            return time()
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    return monotonic_
+
+
+monotonic = _getMonotonic()
@@ -0,0 +1,94 @@
+from os import environ
+import zlib
+
+# zlib level of compressed responses, 0 turns compression off
+COMPRESS_LEVEL = int(environ.get('TXPLAYA_COMPRESS_LEVEL', 6))
+# smallest response body worth compressing, in bytes
+COMPRESS_MIN_SIZE = int(environ.get('TXPLAYA_COMPRESS_MIN_SIZE', 1024))
+
+# content codings by preference, with their zlib window bits
+_CODINGS = (('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS))
+
+
+def acceptedCodings(header):
+    """Content codings an Accept-Encoding `header` does not refuse."""
+    accepted = set()
+    for part in header.split(','):
+        params = part.strip().split(';')
+        coding = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        if quality > 0:
+            accepted.add(coding)
+
+    return accepted
+
+
+def negotiate(request, size=None):
+    """Coding to compress the response to `request` with, None for none.
+
+    Bodies shorter than COMPRESS_MIN_SIZE are sent as they are, streamed
+    responses pass no `size`.
+    """
+    if COMPRESS_LEVEL == 0:
+        return None
+    if size is not None and size < COMPRESS_MIN_SIZE:
+        return None
+
+    header = request.getHeader('accept-encoding')
+    if header is None:
+        return None
+
+    accepted = acceptedCodings(header)
+    for coding, _ in _CODINGS:
+        if coding in accepted or '*' in accepted:
+            return coding
+
+    return None
+
+
+def _compressor(coding):
+    return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, dict(_CODINGS)[coding])
+
+
+def compress(body, coding):
+    compressor = _compressor(coding)
+    return compressor.compress(body) + compressor.flush()
+
+
+def encodedETag(etag, coding):
+    """ETag of the `coding` compressed form of the body tagged `etag`."""
+    if coding is None:
+        return etag
+    return '%s-%s"' % (etag[:-1], coding)
+
+
+class StreamCompressor(object):
+    """Compresses a streamed response in one context.
+
+    Every written part is flushed with Z_SYNC_FLUSH, so the client can
+    decode it as soon as it arrives while later parts still refer back to
+    the earlier ones. With `coding` None parts are passed on as they are.
+    """
+
+    def __init__(self, coding):
+        self.coding = coding
+        self._compressor = None if coding is None else _compressor(coding)
+
+    def compress(self, buf):
+        if self._compressor is None:
+            return buf
+        return self._compressor.compress(buf) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def close(self):
+        """End of the compressed stream, with the gzip trailer."""
+        if self._compressor is None:
+            return ''
+        return self._compressor.flush()
@@ -1,17 +1,68 @@
 import json
-from time import time
+from collections import OrderedDict, deque
+from os import environ
+from os.path import abspath
 
+from zope.interface import implementer
+
+from twisted.internet.interfaces import IPushProducer
 from twisted.web import http
-from twisted.internet import reactor
-from twisted.internet.task import deferLater
+from twisted.internet.defer import Deferred, maybeDeferred
 from twisted.python import log
 
 from werkzeug.urls import url_unquote
 
-from txplaya.track import Track
-from txplaya.player import PlaylistError
+from txplaya.compression import (COMPRESS_LEVEL, StreamCompressor, compress, encodedETag,
+                                  negotiate)
+from txplaya.loader import loadLibraryTracks, deferToLoader
+from txplaya.player import PlaylistError, prepareTrack
+
+# chunks queued for a listener whose connection can not keep up
+STREAM_QUEUE_SIZE = int(environ.get('TXPLAYA_STREAM_QUEUE_SIZE', 25))
+# what to do when the queue is full: dropoldest, liveedge or disconnect
+STREAM_POLICY = environ.get('TXPLAYA_STREAM_POLICY', 'dropoldest')
+STREAM_POLICIES = ('dropoldest', 'liveedge', 'disconnect')
+if STREAM_POLICY not in STREAM_POLICIES:
+    raise ValueError('TXPLAYA_STREAM_POLICY must be one of %s, not %r'
+                     % (', '.join(STREAM_POLICIES), STREAM_POLICY))
+# search and browse results per page, by default and at most
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# compressed forms of shared response bodies kept
+COMPRESSED_CACHE_SIZE = 8
+
+# (body, compressed body) by (etag, coding), see Serialized.compressed
+_compressedBodies = OrderedDict()
+
+
+class Serialized(object):
+    """JSON response body serialized ahead of time, with its ETag.
+
+    A `shared` body is cached by its source and handed to every request,
+    its compressed forms are kept too.
+    """
+
+    __slots__ = ('body', 'etag', 'shared')
+
+    def __init__(self, body, etag, shared=False):
+        self.body = body
+        self.etag = etag
+        self.shared = shared
 
-import txplaya.library
+    def compressed(self, coding):
+        if not self.shared:
+            return compress(self.body, coding)
+
+        key = (self.etag, coding)
+        entry = _compressedBodies.pop(key, None)
+        if entry is None or entry[0] is not self.body:
+            # other responses may share the ETag, the body tells them apart
+            entry = (self.body, compress(self.body, coding))
+
+        _compressedBodies[key] = entry
+        while len(_compressedBodies) > COMPRESSED_CACHE_SIZE:
+            _compressedBodies.popitem(last=False)
+        return entry[1]
 
 
 class BaseController(object):
@@ -22,6 +73,7 @@ class BaseController(object):
         self.request.setHeader('Content-Type', 'text/html')
         self.wait = False
         self.isFinished = False
+        self._stream = None
 
         self.request.notifyFinish().addErrback(self.finishWithError)
 
@@ -30,22 +82,75 @@ class BaseController(object):
 
     def finish(self):
         if not self.isFinished:
+            if self._stream is not None:
+                self.write(self._stream.close())
             self.request.finish()
 
     def finishWithError(self, failure):
         self.isFinished = True
 
+    def _setCoding(self, coding):
+        if COMPRESS_LEVEL > 0:
+            self.request.setHeader('Vary', 'Accept-Encoding')
+        if coding is not None:
+            self.request.setHeader('Content-Encoding', coding)
+
     def writeJson(self, data):
         self.request.setHeader('Content-Type', 'application/json')
-        self.request.write(json.dumps(data).encode('utf-8'))
+        body = json.dumps(data).encode('utf-8')
+
+        if self._stream is not None:
+            # the response is streaming already
+            self.writeStream(body)
+            return
+
+        coding = negotiate(self.request, len(body))
+        self._setCoding(coding)
+        self.write(body if coding is None else compress(body, coding))
 
     def writeJsonLine(self, data):
-        self.request.write((json.dumps(data) + '\n').encode('utf-8'))
+        self.writeStream((json.dumps(data) + '\n').encode('utf-8'))
+
+    def writeStream(self, buf):
+        """Write a part of a streamed response, compressed if negotiated."""
+        if self._stream is None:
+            coding = negotiate(self.request)
+            self._setCoding(coding)
+            self._stream = StreamCompressor(coding)
+
+        self.write(self._stream.compress(buf))
 
     def respondJson(self, data):
+        if isinstance(data, Serialized):
+            return self.respondSerialized(data)
+
         self.writeJson(data)
         self.finish()
 
+    def respondSerialized(self, data):
+        """Respond with pre-serialized JSON, or 304 if the client has it."""
+        self.request.setHeader('Content-Type', 'application/json')
+
+        # compressed bodies differ, and so do their tags
+        coding = negotiate(self.request, len(data.body))
+        self._setCoding(coding)
+        if self.request.setETag(encodedETag(data.etag, coding)) != http.CACHED:
+            self.write(data.body if coding is None else data.compressed(coding))
+        self.finish()
+
+    def respondAction(self, action):
+        """Respond with the result of `action`, which may return a Deferred."""
+        d = maybeDeferred(action)
+        d.addCallback(self.respondJson)
+        d.addErrback(self.respondError)
+
+    def respondError(self, failure):
+        log.err(failure)
+        if self.isFinished:
+            return
+        self.request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+        self.respondJson({'err': failure.getErrorMessage()})
+
 
 class BaseStream(BaseController):
 
@@ -73,40 +178,126 @@ class PlaylistManager(BaseController):
 
         self.request.setResponseCode(http.OK)
 
-        action = getattr(self, action)
-        response = action()
-
-        self.respondJson(response)
+        self.respondAction(getattr(self, action))
 
     @property
     def playlistData(self):
         return self.mainController.playlist.playlistData
 
     def getData(self):
-        return {'playlist': self.playlistData,
-                'hasUndo': self.mainController.playlist.hasUndo,
-                'hasRedo': self.mainController.playlist.hasRedo}
+        body, _, etag = self.mainController.playlist.snapshot()
+        return Serialized(body, etag, shared=True)
+
+    def list_(self):
+        from txplaya.playlistregistry import playlistRegistry
+        body, _, etag = playlistRegistry.listSerialized()
+        return Serialized(body, etag, shared=True)
+
+    def _announceRegistry(self):
+        from txplaya.playlistregistry import playlistRegistry
+        _, line, _ = playlistRegistry.listSerialized()
+        self.mainController.infoListenerRegistry.broadcast(line)
 
     def _insert(self, filepaths):
-        self.mainController.playlist.mark()
+        d = loadLibraryTracks(self.mainController.library, filepaths)
+        d.addCallback(self._onTracksLoaded)
+        return d
 
-        for filepath in filepaths:
-            if not self.mainController.library.pathExists(filepath):
-                continue
-            track = Track(filepath)
-            self.mainController.playlist.insert(track, self.positionArg)
+    def _onTracksLoaded(self, tracks):
+        playlist = self.mainController.playlist
+
+        with playlist.batch():
+            for offset, track in enumerate(tracks):
+                if self.positionArg is None:
+                    playlist.insert(track)
+                else:
+                    playlist.insert(track, self.positionArg + offset)
 
         return {'msg': 'Tracks added'}
 
+    def batch(self):
+        """Apply a list of insert, remove and move operations at once.
+
+        The body is JSON: {"ops": [{"op": "insert", "position": 0,
+        "trackIds": [...]}, {"op": "remove", "position": 2},
+        {"op": "move", "start": 1, "end": 4}]}. Inserts may give
+        "filepaths" instead of library "trackIds".
+        """
+        try:
+            ops = json.loads(self.request.content.read())['ops']
+            for op in ops:
+                if op['op'] != 'insert':
+                    continue
+                op['filepaths'] = list(op.get('filepaths', []))
+                op['trackIds'] = [str(trackId) for trackId in op.get('trackIds', [])]
+        except Exception, err:
+            self.request.setResponseCode(http.BAD_REQUEST)
+            return {'err': repr(err)}
+
+        d = deferToLoader(self._loadBatchTracks, ops)
+        d.addCallback(self._applyBatch, ops)
+        return d
+
+    def _loadBatchTracks(self, ops):
+        # runs in a loader thread, a rescan may hold the library index
+        library = self.mainController.library
+        filepaths = []
+        for op in ops:
+            if op['op'] != 'insert':
+                continue
+            op['filepaths'] = op['filepaths'] + library.trackPaths(op['trackIds'])
+            filepaths.extend(op['filepaths'])
+
+        return library.getTracks(filepaths)
+
+    def _applyBatch(self, tracks, ops):
+        playlist = self.mainController.playlist
+        tracksByPath = dict((track.path, track) for track in tracks)
+
+        try:
+            with playlist.batch():
+                for op in ops:
+                    self._applyBatchOp(playlist, op, tracksByPath)
+
+        except (KeyError, IndexError, TypeError, ValueError), err:
+            self.request.setResponseCode(http.BAD_REQUEST)
+            return {'err': repr(err)}
+
+        return {'msg': 'Batch applied',
+                'hasUndo': playlist.hasUndo,
+                'hasRedo': playlist.hasRedo}
+
+    def _applyBatchOp(self, playlist, op, tracksByPath):
+        kind = op['op']
+
+        if kind == 'insert':
+            position = op.get('position')
+            tracks = [tracksByPath[abspath(filepath)] for filepath in op['filepaths']
+                      if abspath(filepath) in tracksByPath]
+            for offset, track in enumerate(tracks):
+                if position is None:
+                    playlist.insert(track)
+                else:
+                    playlist.insert(track, int(position) + offset)
+
+        elif kind == 'remove':
+            playlist.remove(int(op['position']))
+
+        elif kind == 'move':
+            playlist.move(int(op['start']), int(op['end']))
+
+        else:
+            raise ValueError('Unknown operation %s' % kind)
+
     def insert(self):
         filepath = '/' + url_unquote(self.filepathArg)
         return self._insert([filepath])
 
     def libraryInsert(self):
         trackIds = self.trackIdsArg.split(',')
-        filepaths = [txplaya.library.Library.decodePath(trackId)
-                     for trackId in trackIds]
-        return self._insert(filepaths)
+        d = deferToLoader(self.mainController.library.trackPaths, trackIds)
+        d.addCallback(self._insert)
+        return d
 
     def remove(self):
         try:
@@ -122,10 +313,11 @@ class PlaylistManager(BaseController):
         playlist = self.mainController.playlist
         start, end = self.startArg, self.endArg
 
-        if start == end or start + 1 == end:
-            return self.getData()
-
-        playlist.move(start, end)
+        try:
+            playlist.move(start, end)
+        except IndexError:
+            self.request.setResponseCode(http.NOT_FOUND)
+            return {'msg': 'Track out of bounds'}
 
         return self.getData()
 
@@ -135,13 +327,9 @@ class PlaylistManager(BaseController):
                 'playlist': self.playlistData}
 
     def save(self):
-        from txplaya.playlistregistry import playlistRegistry
         playlistName = url_unquote(self.playlistNameArg)
         self.mainController.playlist.save(playlistName)
-
-        event = {'event': 'PlaylistRegistryUpdated',
-                 'data': {'list': playlistRegistry.list_()}}
-        self.mainController.announce(event)
+        self._announceRegistry()
 
         return {'msg': 'Playlist saved'}
 
@@ -155,10 +343,7 @@ class PlaylistManager(BaseController):
         from txplaya.playlistregistry import playlistRegistry
         playlistName = url_unquote(self.playlistNameArg)
         playlistRegistry.deletePlaylist(playlistName)
-
-        event = {'event': 'PlaylistRegistryUpdated',
-                 'data': {'list': playlistRegistry.list_()}}
-        self.mainController.announce(event)
+        self._announceRegistry()
 
         return {'msg': 'Playlist deleted'}
 
@@ -180,10 +365,7 @@ class Player(BaseController):
 
         self.request.setResponseCode(http.OK)
 
-        action = getattr(self, action)
-        response = action()
-
-        self.respondJson(response)
+        self.respondAction(getattr(self, action))
 
     def start(self):
         if self.positionArg is None:
@@ -197,18 +379,38 @@ class Player(BaseController):
         except PlaylistError, err:
             return {'err': repr(err)}
 
+        self.mainController.resetPrefetch()
+
+        track = self.mainController.playlist.currentTrack
+        d = deferToLoader(prepareTrack, track)
+        d.addCallbacks(self._onTrackPrepared, self._onTrackFailed,
+                       callbackArgs=(track,), errbackArgs=(track,))
+        return d
+
+    def _onTrackPrepared(self, chunks, track):
+        playlist = self.mainController.playlist
+        if playlist.currentTrack is not track:
+            # another start came in while this one was loading
+            chunks.close()
+            return {'msg': 'Superseded'}
+
         player = self.mainController.player
+        player.feedChunks(chunks, clear=True)
+        player.start()
+        return {'msg': 'Started'}
+
+    def _onTrackFailed(self, failure, track):
         playlist = self.mainController.playlist
+        if playlist.currentTrack is not track:
+            return {'msg': 'Superseded'}
 
-        try:
-            player.feed(playlist.currentTrack, clear=True)
-        except IOError:
-            currentPosition = playlist.currentPosition
-            playlist.remove(playlist.currentPosition, emit=False)
-            self._start(currentPosition)
+        if failure.check(IOError, OSError):
+            log.msg('{0} can not be read'.format(repr(track.path)))
         else:
-            player.start()
-            return {'msg': 'Started'}
+            log.err(failure, '{0} can not be played'.format(repr(track.path)))
+        currentPosition = playlist.currentPosition
+        playlist.remove(currentPosition)
+        return self._start(currentPosition)
 
     def next(self):
         position = self.mainController.playlist.currentPosition
@@ -223,10 +425,21 @@ class Player(BaseController):
         return self._start(position - 1)
 
     def stop(self):
+        self.mainController.resetPrefetch()
         self.mainController.player.stop()
         self.mainController.playlist.stop()
         return {'msg': 'Stoped'}
 
+    def stats(self):
+        listeners = [listener.stats
+                     for listener in self.mainController.listenerRegistry.iterListeners()]
+        player = self.mainController.player
+        recentLateness, recentReadTime = player.stress()
+        return {'lateness': player.lateness.data,
+                'recentLatenessMs': recentLateness * 1000,
+                'recentReadMs': recentReadTime * 1000,
+                'listeners': listeners}
+
     def pause(self):
         if self.mainController.player.paused:
             self.mainController.player.resume()
@@ -237,81 +450,292 @@ class Player(BaseController):
         return {'msg': msg}
 
 
+@implementer(IPushProducer)
 class Stream(BaseStream):
 
     def __init__(self, request):
         BaseStream.__init__(self, request)
 
+        self.queue = deque()
+        self.paused = False
+        self.sentBytes = 0
+        self.droppedBytes = 0
+        self.droppedChunks = 0
+
         self.request.setHeader('Content-Type', 'audio/mpeg')
         self.request.setHeader('Transfer-Encoding', 'chunked')
         self.request.setHeader('Content-Transfer-Encoding', 'binary')
         self.request.setHeader('Accept-Ranges', 'bytes')
         self.request.setHeader('Content-Disposition', 'inline')
 
+        self.request.registerProducer(self, True)
         self.mainController.listenerRegistry.add(self)
 
         # push history to it
         for buf in tuple(self.mainController.player.history):
             self.onPush(buf)
 
+    def onPush(self, buf):
+        if self.isFinished:
+            return
+
+        if not self.paused:
+            self.write(buf)
+            self.sentBytes = self.sentBytes + len(buf)
+            return
+
+        self.queue.append(buf)
+        if len(self.queue) <= STREAM_QUEUE_SIZE:
+            return
+
+        if STREAM_POLICY == 'disconnect':
+            log.msg('Disconnecting slow listener %s' % self.request.getClientIP())
+            # the send buffer is not drained, it is what the listener lags behind
+            self._drop(len(self.queue))
+            self.isFinished = True
+            self.mainController.listenerRegistry.remove(self)
+            self.request.transport.abortConnection()
+
+        elif STREAM_POLICY == 'liveedge':
+            # skip everything but the newest chunk
+            self._drop(len(self.queue) - 1)
+
+        else:
+            self._drop(len(self.queue) - STREAM_QUEUE_SIZE)
+
+    def _drop(self, count):
+        for _ in xrange(count):
+            buf = self.queue.popleft()
+            self.droppedBytes = self.droppedBytes + len(buf)
+            self.droppedChunks = self.droppedChunks + 1
+
+    @property
+    def stats(self):
+        return {'client': self.request.getClientIP(),
+                'sentBytes': self.sentBytes,
+                'queuedChunks': len(self.queue),
+                'droppedBytes': self.droppedBytes,
+                'droppedChunks': self.droppedChunks}
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+        if len(self.queue) > 0 and not self.isFinished:
+            buf = ''.join(self.queue)
+            self.queue.clear()
+            self.write(buf)
+            self.sentBytes = self.sentBytes + len(buf)
+
+    def stopProducing(self):
+        self.queue.clear()
+        self.isFinished = True
+
     def onConnectionLost(self, reason):
+        self.queue.clear()
         self.mainController.listenerRegistry.remove(self)
 
 
 class Library(BaseController):
 
-    def __init__(self, request, action):
+    def __init__(self, request, action, artistId=None, albumId=None):
         BaseController.__init__(self, request)
 
         self.request.setResponseCode(http.OK)
+        self.artistId = artistId
+        self.albumId = albumId
 
         action = getattr(self, action)
         response = action()
 
-        if not self.wait:
-            self.respondJson(response)
-        else:
+        if self.wait:
             self.request.setHeader('Content-Type', 'application/json')
+        elif isinstance(response, Deferred):
+            response.addCallback(self.respondJson)
+            response.addErrback(self.respondError)
+        else:
+            self.respondJson(response)
 
-    def rescan(self):
-        self.mainController.library.clear()
-        self.dirs = self.mainController.library.scanDirs()
+    def rescan(self, full=False):
+        """Stream the progress of the running rescan, started if none runs."""
+        job = self.mainController.scanManager.start(full)
+        job.listen(self._onScanProgress)
 
-        self.startTime = time()
-        self.total = len(self.dirs)
-        self.progress = 0
+        d = job.whenDone()
+        d.addCallback(self.scanFinished)
+        d.addErrback(self.respondError)
 
-        self._loopScan()
         self.wait = True
 
-    def _loopScan(self):
-        if len(self.dirs) == 0:
-            return self.scanFinished()
-
-        dirname, filenames = self.dirs.pop()
-        self.mainController.library.scanFiles(dirname, filenames)
+    def rescanFull(self):
+        return self.rescan(full=True)
 
-        newProgress = int((1. - len(self.dirs) * 1.0 / self.total) * 100)
+    def _onScanProgress(self, progress):
+        if not self.isFinished:
+            self.writeJsonLine({'scanprogress': progress})
 
-        if int(newProgress) > self.progress:
-            self.progress = newProgress
-            self.writeJsonLine({'scanprogress': newProgress})
+    def scanFinished(self, status):
+        if self.isFinished:
+            return
 
-        deferLater(reactor, 0, self._loopScan)
+        response = dict(status, msg='Rescan %s' % status['state'])
+        if status['state'] == 'finished' and self.request.args.get('library', ['0'])[0] == '1':
+            # the full dump, for clients that do not browse
+            d = deferToLoader(lambda: self.mainController.library.data)
+            d.addCallback(self._onScanDump, response)
+            d.addErrback(self.respondError)
+            return
 
-    def scanFinished(self):
-        library = self.mainController.library
+        self.writeJsonLine(response)
+        self.finish()
 
-        log.msg('Rescan finised in %d seconds.' % int(time() - self.startTime))
-        log.msg('Total tracks: %d' % len(library.data))
-        library.saveBin()
+    def _onScanDump(self, data, response):
+        if self.isFinished:
+            return
 
-        self.writeJsonLine({'msg': 'Rescan finished',
-                            'library': library.data})
+        response['library'] = data
+        self.writeJsonLine(response)
         self.finish()
 
+    def scanStatus(self):
+        return self.mainController.scanManager.status()
+
+    def scanStart(self, full=False):
+        """Start a rescan in the background, or report on the running one."""
+        self.mainController.scanManager.start(full)
+        return self.scanStatus()
+
+    def scanStartFull(self):
+        return self.scanStart(full=True)
+
+    def scanCancel(self):
+        if not self.mainController.scanManager.cancel():
+            self.request.setResponseCode(http.CONFLICT)
+            return {'err': 'No rescan to cancel'}
+        return self.scanStatus()
+
+    def scanResume(self):
+        if self.mainController.scanManager.resume() is None:
+            self.request.setResponseCode(http.CONFLICT)
+            return {'err': 'No rescan to resume'}
+        return self.scanStatus()
+
+    # the library queries run in loader threads, a rescan applying its
+    # changes holds the index for a while and the reactor must not wait
+
     def getLibrary(self):
-        return {'library': self.mainController.library.data}
+        d = deferToLoader(self.mainController.library.serialized)
+        d.addCallback(self._onLibrarySerialized)
+        return d
+
+    def _onLibrarySerialized(self, serialized):
+        body, etag = serialized
+        return Serialized(body, etag, shared=True)
+
+    def _serialized(self, data, version):
+        """`data` tagged with the library `version`, which also makes the ETag.
+
+        The version is taken before the query, a change applied meanwhile
+        makes clients fetch again rather than keep stale data.
+        """
+        data['version'] = version
+        return Serialized(json.dumps(data), '"%s"' % version)
+
+    def _page(self):
+        """(offset, limit) of the request, limit clamped to MAX_PAGE_SIZE."""
+        args = self.request.args
+        offset = max(0, int(args.get('offset', [0])[0]))
+        limit = int(args.get('limit', [PAGE_SIZE])[0])
+        return offset, max(1, min(limit, MAX_PAGE_SIZE))
+
+    def _badPage(self):
+        self.request.setResponseCode(http.BAD_REQUEST)
+        return {'err': 'offset and limit must be integers'}
+
+    def search(self):
+        query = self.request.args.get('q', [''])[0].decode('utf-8', 'replace')
+
+        try:
+            offset, limit = self._page()
+        except ValueError:
+            return self._badPage()
+
+        return deferToLoader(self._searchPage, query, offset, limit)
+
+    def _searchPage(self, query, offset, limit):
+        library = self.mainController.library
+        version = library.version
+        total, tracks = library.search(query, offset, limit)
+
+        response = {'query': query,
+                    'total': total,
+                    'offset': offset,
+                    'limit': limit,
+                    'results': [dict(meta, trackId=trackId) for trackId, meta in tracks]}
+        return self._serialized(response, version)
+
+    def artists(self):
+        try:
+            offset, limit = self._page()
+        except ValueError:
+            return self._badPage()
+
+        return deferToLoader(self._artistsPage, offset, limit)
+
+    def _artistsPage(self, offset, limit):
+        library = self.mainController.library
+        version = library.version
+        total, rows = library.artists(offset, limit)
+
+        response = {'total': total,
+                    'offset': offset,
+                    'limit': limit,
+                    'artists': [{'id': artistId, 'name': name, 'tracks': trackCount}
+                                for artistId, name, trackCount in rows]}
+        return self._serialized(response, version)
+
+    def albums(self):
+        try:
+            offset, limit = self._page()
+        except ValueError:
+            return self._badPage()
+
+        return deferToLoader(self._albumsPage, offset, limit)
+
+    def _albumsPage(self, offset, limit):
+        library = self.mainController.library
+        version = library.version
+        total, rows = library.albums(self.artistId, offset, limit)
+
+        response = {'artistId': self.artistId,
+                    'total': total,
+                    'offset': offset,
+                    'limit': limit,
+                    'albums': [{'id': albumId, 'name': name, 'year': year, 'tracks': trackCount}
+                               for albumId, name, year, trackCount in rows]}
+        return self._serialized(response, version)
+
+    def albumTracks(self):
+        try:
+            offset, limit = self._page()
+        except ValueError:
+            return self._badPage()
+
+        return deferToLoader(self._albumTracksPage, offset, limit)
+
+    def _albumTracksPage(self, offset, limit):
+        library = self.mainController.library
+        version = library.version
+        total, tracks = library.albumTracks(self.albumId, offset, limit)
+
+        response = {'albumId': self.albumId,
+                    'total': total,
+                    'offset': offset,
+                    'limit': limit,
+                    'tracks': [dict(meta, trackId=trackId) for trackId, meta in tracks]}
+        return self._serialized(response, version)
 
 
 class InfoStream(BaseStream):
@@ -344,18 +768,16 @@ class InfoStream(BaseStream):
                      'data': {'paused': self.mainController.player.paused}}
             self.writeJsonLine(event)
 
-        # push playlist data
-        event = {'event': 'PlaylistChanged',
-                 'data': {'playlist': playlist.playlistData,
-                          'position': playlist.currentPosition,
-                          'hasUndo': playlist.hasUndo,
-                          'hasRedo': playlist.hasRedo}}
-        self.writeJsonLine(event)
+        # push playlist data, later changes arrive as deltas
+        _, line, _ = playlist.snapshot()
+        self.writeStream(line)
 
         # push list of playlists
-        event = {'event': 'PlaylistRegistryUpdated',
-                 'data': {'list': playlistRegistry.list_()}}
-        self.writeJsonLine(event)
+        _, line, _ = playlistRegistry.listSerialized()
+        self.writeStream(line)
+
+    def onPush(self, buf):
+        self.writeStream(buf)
 
     def onConnectionLost(self, reason):
         self.mainController.infoListenerRegistry.remove(self)
@@ -0,0 +1,114 @@
+from contextlib import contextmanager
+import ctypes
+import ctypes.util
+import os
+import platform
+
+# posix_fadvise advice, as numbered on linux
+FADV_WILLNEED = 3
+FADV_DONTNEED = 4
+
+# io scheduling classes of ioprio_set
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO_WHO_PROCESS = 1
+
+# (ioprio_set, ioprio_get) syscall numbers by machine
+_IOPRIO_SYSCALLS = {'x86_64': (251, 252),
+                    'i386': (289, 290),
+                    'i686': (289, 290),
+                    'aarch64': (30, 31),
+                    'armv7l': (314, 315)}
+
+
+def _getLibc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+
+
+_libc = _getLibc()
+
+
+def _getFadvise():
+    """posix_fadvise of libc with its argument types, None if there is none.
+
+    posix_fadvise64 takes 64 bit offsets everywhere, posix_fadvise takes an
+    off_t, which is as long as a C long.
+    """
+    for name, offsetType in (('posix_fadvise64', ctypes.c_int64),
+                             ('posix_fadvise', ctypes.c_long)):
+        function = getattr(_libc, name, None) if _libc is not None else None
+        if function is not None:
+            function.argtypes = (ctypes.c_int, offsetType, offsetType, ctypes.c_int)
+            function.restype = ctypes.c_int
+            return function
+    return None
+
+
+_fadvise = _getFadvise()
+
+
+def fadvise(fd, advice, offset=0, length=0):
+    """Tell the kernel how the file `fd` is going to be read, if it listens."""
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, offset, length, advice)
+        return
+
+    if _fadvise is not None:
+        _fadvise(fd, offset, length, advice)
+
+
+def dropCache(path_):
+    """Evict the cached pages of a file read once, so they do not push out others."""
+    try:
+        fd = os.open(path_, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        fadvise(fd, FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def _ioprioSyscall(index, *args):
+    numbers = _IOPRIO_SYSCALLS.get(platform.machine())
+    if _libc is None or numbers is None:
+        return -1
+    return _libc.syscall(numbers[index], *args)
+
+
+def getIoPriority():
+    """io priority of the calling thread, None where it is not known."""
+    priority = _ioprioSyscall(1, _IOPRIO_WHO_PROCESS, 0)
+    if priority < 0:
+        return None
+    return priority
+
+
+def setIoPriority(ioClass, level=0):
+    """Set the io class of the calling thread, returns whether it was set.
+
+    On linux every thread has its own io priority, the other threads of
+    the process keep theirs.
+    """
+    priority = (ioClass << _IOPRIO_CLASS_SHIFT) | level
+    return _ioprioSyscall(0, _IOPRIO_WHO_PROCESS, 0, priority) == 0
+
+
+@contextmanager
+def lowIoPriority():
+    """Run the block with the lowest best effort io priority of the thread."""
+    previous = getIoPriority()
+    if previous is None or not setIoPriority(IOPRIO_CLASS_BE, 7):
+        yield
+        return
+
+    try:
+        yield
+    finally:
+        _ioprioSyscall(0, _IOPRIO_WHO_PROCESS, 0, previous)
@@ -1,10 +1,14 @@
-from os.path import dirname, abspath
+from os.path import dirname, abspath, exists
 from os.path import join as path_join
-from os import environ, walk, pathsep, stat
+from os import environ, walk, pathsep, stat, rename
+from stat import S_ISREG
 from zlib import compress, decompress
 from base64 import urlsafe_b64encode, urlsafe_b64decode
+import json
 import pickle
 
+from txplaya.search import tokenize
+from txplaya.store import LibraryStore, groupKeys, TRACK_ID_LENGTH
 from txplaya.track import Track
 
 if 'TXPLAYA_LIBPATH' in environ:
@@ -13,25 +17,94 @@ else:
     from os.path import expanduser
     PATH = path_join(expanduser('~'), 'Music')
 
+DBPATH = path_join(dirname(dirname(__file__)), '.library.db')
+# pickled index of earlier versions, migrated into the database
 BINPATH = path_join(dirname(dirname(__file__)), '.library')
 
 
+def readMeta(path_):
+    """Tags of the audio file at `path_`, None if it is not a usable track."""
+    track = Track(path_)
+    if not track.has_tags or track.trackName == '':
+        return None
+    return track.meta
+
+
+def withGroupIds(meta):
+    """`meta` with the artistId and albumId of its browse groups."""
+    _artistKey, artistId, albumId = groupKeys(meta)
+    return dict(meta, artistId=artistId, albumId=albumId)
+
+
+def fileStat(st):
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+def isCandidate(st):
+    """Whether a file of stat `st` is worth parsing for tags."""
+    size = st.st_size / 1000 # kB
+    return S_ISREG(st.st_mode) and 100 <= size <= 100000
+
+
 class Library(object):
 
     def __init__(self):
-        try:
-            self.readBin()
-        except Exception:
-            self._lib = {}
+        self._store = LibraryStore(DBPATH)
+        self._full = False
+        self._staged = set()
+        self._serialized = None
+
+        if self._store.isEmpty() and exists(BINPATH):
+            self.migrateBin()
+
+    def __len__(self):
+        """Number of tracks, counted without reading them."""
+        return len(self._store)
 
     @property
     def data(self):
-        return self._lib.copy()
+        return dict(self._store.tracks())
+
+    @property
+    def version(self):
+        return self._store.version
+
+    @property
+    def etag(self):
+        return '"%s"' % self._store.version
 
-    def readBin(self):
+    def serialized(self):
+        """(body, etag) of the whole library as JSON, cached per version."""
+        version = self._store.version
+        if self._serialized is None or self._serialized[0] != version:
+            body = json.dumps({'library': self.data, 'version': version})
+            self._serialized = (version, body, self.etag)
+
+        return self._serialized[1:]
+
+    def migrateBin(self):
+        """Move the pickled index into the database, once."""
         with open(BINPATH, 'rb') as f:
-            self._lib = pickle.loads(decompress(f.read()))
+            content = pickle.loads(decompress(f.read()))
+
+        if isinstance(content, tuple):
+            lib, stats = content
+        else:
+            # saved before file stats were kept
+            lib, stats = content, {}
+
+        for trackId in set(lib) | set(stats):
+            stat_ = stats.get(trackId)
+            if stat_ is not None and len(stat_) == 2:
+                stat_ = stat_ + (None,)
+            self._store.put(Library.decodePath(trackId), stat_, lib.get(trackId))
 
+        self._store.bumpVersion()
+        self._store.commit()
+        rename(BINPATH, BINPATH + '.migrated')
+
+    # paths were encoded into track ids before tracks had short ids,
+    # clients may still send these
     @classmethod
     def encodePath(cls, path):
         return urlsafe_b64encode(compress(path))
@@ -41,9 +114,6 @@ class Library(object):
         compressed = urlsafe_b64decode(str(encodedPath))
         return decompress(compressed)
 
-    def clear(self):
-        self._lib.clear()
-
     def scanDirs(self):
         paths = map(abspath, PATH.split(pathsep))
 
@@ -55,28 +125,215 @@ class Library(object):
 
         return result
 
+    def beginScan(self, full=False):
+        """Start a rescan, a full one parses every file again.
+
+        Files whose mtime, size and inode did not change since the last
+        scan are skipped. Files moved within the library keep their tags
+        without being parsed again. The scan is staged and swapped into
+        the index by endScan, files it did not see are pruned then.
+        """
+        self._full = full
+        self._staged = set()
+        self._store.beginStaging(full)
+
+    def scanCheckpoint(self):
+        """(full, cancelled) of a scan left unfinished, None if there is none."""
+        return self._store.stagedScan()
+
+    def resumeScan(self):
+        """Carry on with the unfinished scan, files it staged are skipped.
+
+        Returns whether the scan was a full one.
+        """
+        full, _cancelled = self._store.stagedScan()
+        self._full = full
+        self._staged = self._store.stagedPaths()
+        self._store.setStagingCancelled(False)
+        return full
+
+    def cancelScan(self):
+        """Stop staging, the scan is left to resumeScan."""
+        self._store.setStagingCancelled(True)
+        self._full = False
+        self._staged = set()
+
     def scanFiles(self, dirpath, filenames):
+        """Check the files of `dirpath` against the index.
+
+        Returns (path, stat) of the files whose tags need to be parsed,
+        see storeParsed.
+        """
+        pending = []
         for filename in filenames:
             path_ = path_join(dirpath, filename)
+            if path_ in self._staged:
+                continue
+
+            try:
+                st = stat(path_)
+            except OSError:
+                continue
 
-            size = stat(path_).st_size / 1000 # kB
-            if size < 100 or size > 100000:
+            if not isCandidate(st):
                 continue
 
-            track = Track(path_)
-            if not track.has_tags or track.trackName == '':
+            stat_ = fileStat(st)
+            if self._full:
+                pending.append((path_, stat_))
                 continue
 
-            trackId = Library.encodePath(path_)
-            meta = track.meta
-            if meta is not None:
-                self._lib[trackId] = meta
+            known = self._store.getStat(path_)
+
+            if known is not None and known[:2] == stat_[:2] and known[2] in (None, stat_[2]):
+                # unchanged, stats saved before inodes were kept are upgraded
+                self._store.stage(path_, stat_, None, parsed=False)
+                continue
+
+            if known is None:
+                movedMeta = self._store.findByStat(stat_)
+                if movedMeta is not None:
+                    self._store.stage(path_, stat_, movedMeta)
+                    continue
+
+            pending.append((path_, stat_))
+
+        return pending
+
+    def storeParsed(self, path_, stat_, meta):
+        self._store.stage(path_, stat_, meta)
 
-    def saveBin(self):
-        with open(BINPATH, 'wb') as f:
-            f.write(compress(pickle.dumps(self._lib, 1)))
+    def endScan(self):
+        """Swap the scan into the index and return the scan counts.
+
+        Blocking, readers wait for the swap to be done.
+        """
+        counts = self._store.applyStaged()
+        self._full = False
+        self._staged = set()
+        return counts
+
+    def knownUnder(self, dirpath):
+        """Paths of the indexed files below `dirpath`."""
+        return self._store.pathsUnder(dirpath.rstrip('/') + '/')
+
+    def readChanges(self, paths):
+        """Parse files reported as changed, returns (path, stat, meta).
+
+        Blocking, meant for a loader thread; the library is left untouched.
+        Files that are gone or are not tracks come back with stat None,
+        unchanged files are left out.
+        """
+        results = []
+        for path_ in paths:
+            try:
+                st = stat(path_)
+            except OSError:
+                results.append((path_, None, None))
+                continue
+
+            if not isCandidate(st):
+                results.append((path_, None, None))
+                continue
+
+            stat_ = fileStat(st)
+            if self._store.getStat(path_) == stat_:
+                continue
+
+            try:
+                meta = readMeta(path_)
+            except Exception:
+                meta = None
+            results.append((path_, stat_, meta))
+
+        return results
+
+    def applyChanges(self, results):
+        """Merge readChanges results, returns a LibraryChanged delta."""
+        delta = {'added': {}, 'updated': {}, 'removed': []}
+
+        for path_, stat_, meta in results:
+            # None for files that were no track
+            knownId = self._store.trackId(path_)
+
+            if stat_ is None:
+                self._store.delete(path_)
+                trackId = None
+            else:
+                trackId = self._store.put(path_, stat_, meta)
+
+            if meta is None:
+                if knownId is not None:
+                    delta['removed'].append(knownId)
+                continue
+
+            delta['updated' if knownId is not None else 'added'][trackId] = withGroupIds(meta)
+
+        if any(delta.itervalues()):
+            self._store.bumpVersion()
+        self._store.commit()
+
+        delta['version'] = self._store.version
+        return delta
+
+    def search(self, query, offset=0, limit=50):
+        """Ranked page of the tracks matching all words of `query`.
+
+        Returns the total number of matches and (trackId, meta) pairs.
+        """
+        total, tracks = self._store.search(tokenize(query), offset, limit)
+        return total, [(trackId, withGroupIds(meta)) for trackId, meta in tracks]
+
+    def artists(self, offset=0, limit=50):
+        return self._store.artists(offset, limit)
+
+    def albums(self, artistId, offset=0, limit=50):
+        return self._store.albums(artistId, offset, limit)
+
+    def albumTracks(self, albumId, offset=0, limit=50):
+        total, tracks = self._store.albumTracks(albumId, offset, limit)
+        return total, [(trackId, withGroupIds(meta)) for trackId, meta in tracks]
+
+    def trackPaths(self, trackIds):
+        """Paths of the library tracks `trackIds`, unknown ones left out."""
+        known = self._store.trackPaths([trackId for trackId in trackIds
+                                        if len(trackId) <= TRACK_ID_LENGTH])
+
+        paths = []
+        for trackId in trackIds:
+            if len(trackId) > TRACK_ID_LENGTH:
+                paths.append(Library.decodePath(trackId))
+            elif trackId in known:
+                paths.append(known[trackId])
+
+        return paths
 
     def pathExists(self, filepath):
+        return self._store.hasTrack(abspath(filepath))
+
+    def getTrack(self, filepath):
+        """Track for `filepath` built from the library index.
+
+        Returns None for paths not in the library. The file is parsed again
+        only when its mtime or size differ from the scanned ones.
+        """
         filepath = abspath(filepath)
-        trackUid = Library.encodePath(filepath)
-        return trackUid in self._lib
+
+        known, meta = self._store.get(filepath)
+        if meta is None:
+            return None
+
+        try:
+            st = stat(filepath)
+        except OSError:
+            # missing files are dealt with when played
+            return Track.fromMeta(filepath, meta)
+
+        if known[:2] != (st.st_mtime, st.st_size):
+            return Track(filepath)
+
+        return Track.fromMeta(filepath, meta)
+
+    def getTracks(self, filepaths):
+        tracks = (self.getTrack(filepath) for filepath in filepaths)
+        return [track for track in tracks if track is not None]
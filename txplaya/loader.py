@@ -0,0 +1,64 @@
+from os import environ
+
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList
+from twisted.internet.threads import deferToThreadPool
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+
+from txplaya.track import Track
+
+# worker threads for tag parsing and file reads, kept off the reactor thread
+LOADER_THREADS = int(environ.get('TXPLAYA_LOADER_THREADS', 4))
+
+_pool = None
+
+
+def getPool():
+    global _pool
+
+    if _pool is None:
+        _pool = ThreadPool(minthreads=0, maxthreads=LOADER_THREADS, name='txplaya-loader')
+        _pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', _pool.stop)
+
+    return _pool
+
+
+def deferToLoader(f, *args, **kwargs):
+    return deferToThreadPool(reactor, getPool(), f, *args, **kwargs)
+
+
+def loadTrack(path):
+    """Deferred firing with the parsed Track of `path`."""
+    return deferToLoader(Track, path)
+
+
+def loadLibraryTracks(library, paths):
+    """Deferred firing with Tracks of the library `paths`, in order.
+
+    Tracks are built from the library index, see Library.getTrack.
+    """
+    return deferToLoader(library.getTracks, list(paths))
+
+
+def _collectTracks(results, paths):
+    tracks = []
+    for path, (success, result) in zip(paths, results):
+        if success:
+            tracks.append(result)
+        else:
+            log.msg('Track {0} could not be loaded: {1}'.format(
+                repr(path), result.getErrorMessage()))
+    return tracks
+
+
+def loadTracks(paths):
+    """Deferred firing with the Tracks of `paths` in the same order.
+
+    Paths that fail to load are logged and left out.
+    """
+    paths = list(paths)
+    d = DeferredList([loadTrack(path) for path in paths], consumeErrors=True)
+    d.addCallback(_collectTracks, paths)
+    return d
@@ -0,0 +1,159 @@
+from array import array
+from struct import unpack
+
+BLOCK_SIZE = 65536
+
+# bitrates in kbps, indexed by (version is MPEG1, layer) and the header index
+_BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)}
+
+# sample rates indexed by the header version bits
+_SAMPLERATES = {0: (11025, 12000, 8000),
+                2: (22050, 24000, 16000),
+                3: (44100, 48000, 32000)}
+
+
+def parseHeader(buf, offset=0):
+    """Parse the MPEG audio frame header at `offset`.
+
+    Returns (frameSize, duration, headerKey) or None if there is no valid
+    header. Frames of one stream share the same headerKey.
+    """
+    if len(buf) < offset + 4:
+        return None
+
+    b0, b1, b2 = unpack('BBB', buf[offset:offset + 3])
+    if b0 != 0xFF or b1 & 0xE0 != 0xE0:
+        return None
+
+    versionBits = (b1 >> 3) & 3
+    layer = 4 - ((b1 >> 1) & 3)
+    bitrateIdx = b2 >> 4
+    sampleRateIdx = (b2 >> 2) & 3
+    padding = (b2 >> 1) & 1
+
+    if versionBits == 1 or layer == 4 or bitrateIdx in (0, 15) or sampleRateIdx == 3:
+        return None
+
+    isMpeg1 = (versionBits == 3)
+    bitrate = _BITRATES[(isMpeg1, layer)][bitrateIdx] * 1000
+    sampleRate = _SAMPLERATES[versionBits][sampleRateIdx]
+
+    if layer == 1:
+        samples = 384
+        frameSize = (12 * bitrate // sampleRate + padding) * 4
+    elif layer == 2 or isMpeg1:
+        samples = 1152
+        frameSize = 144 * bitrate // sampleRate + padding
+    else:
+        samples = 576
+        frameSize = 72 * bitrate // sampleRate + padding
+
+    return frameSize, samples * 1.0 / sampleRate, (versionBits, layer, sampleRate)
+
+
+def id3v2Size(header):
+    """Size of the ID3v2 tag starting the file, 0 if there is none."""
+    if len(header) < 10 or header[:3] != 'ID3':
+        return 0
+
+    flags = ord(header[5])
+    s0, s1, s2, s3 = unpack('BBBB', header[6:10])
+    size = (s0 << 21) | (s1 << 14) | (s2 << 7) | s3
+    size = size + 10
+    if flags & 0x10:
+        # footer present
+        size = size + 10
+    return size
+
+
+class FrameIndex(object):
+    """Offsets and durations of all MPEG audio frames in a file.
+
+    `offsets` and `durations` are compact arrays, `end` is the offset just
+    past the last frame.
+    """
+
+    __slots__ = ('offsets', 'durations', 'end', 'length')
+
+    def __init__(self):
+        self.offsets = array('L')
+        self.durations = array('f')
+        self.end = 0
+        self.length = 0.0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @classmethod
+    def fromFile(cls, fileobj):
+        index = cls()
+
+        fileobj.seek(0)
+        position = id3v2Size(fileobj.read(10))
+
+        buf, bufStart = '', position
+        synced = False
+        headerKey = None
+
+        while True:
+            rel = position - bufStart
+            if rel < 0 or rel + 8 > len(buf):
+                fileobj.seek(position)
+                buf, bufStart, rel = fileobj.read(BLOCK_SIZE), position, 0
+                if len(buf) < 4:
+                    break
+
+            header = parseHeader(buf, rel)
+
+            if header is not None and not synced:
+                # require the following frame to match before trusting a sync
+                frameSize, _duration, key = header
+                nextRel = rel + frameSize
+                if nextRel + 4 > len(buf):
+                    fileobj.seek(position)
+                    buf, bufStart, rel = fileobj.read(frameSize + BLOCK_SIZE), position, 0
+                    nextRel = frameSize
+
+                if nextRel + 4 <= len(buf):
+                    nextHeader = parseHeader(buf, nextRel)
+                    if nextHeader is None or nextHeader[2] != key:
+                        header = None
+
+            if header is not None and synced and header[2] != headerKey:
+                header = None
+
+            if header is None:
+                # lost sync, look for the next candidate
+                synced = False
+                found = buf.find('\xff', rel + 1)
+                if found == -1:
+                    position = bufStart + len(buf)
+                else:
+                    position = bufStart + found
+                continue
+
+            frameSize, duration, headerKey = header
+            synced = True
+
+            index.offsets.append(position)
+            index.durations.append(duration)
+            index.length = index.length + duration
+
+            position = position + frameSize
+            index.end = position
+
+        fileobj.seek(0, 2)
+        index.end = min(index.end, fileobj.tell())
+
+        return index
+
+    def frameEnd(self, frame):
+        if frame + 1 < len(self.offsets):
+            return self.offsets[frame + 1]
+        return self.end
@@ -0,0 +1,153 @@
+from random import random
+
+
+class _Node(object):
+
+    __slots__ = ('value', 'priority', 'size', 'left', 'right', 'parent')
+
+    def __init__(self, value):
+        self.value = value
+        self.priority = random()
+        self.size = 1
+        self.left = self.right = self.parent = None
+
+
+def _size(node):
+    if node is None:
+        return 0
+    return node.size
+
+
+def _update(node):
+    node.size = 1 + _size(node.left) + _size(node.right)
+    if node.left is not None:
+        node.left.parent = node
+    if node.right is not None:
+        node.right.parent = node
+
+
+def _split(node, count):
+    """Split into a tree of the first `count` items and one of the rest."""
+    if node is None:
+        return None, None
+
+    leftSize = _size(node.left)
+    if leftSize >= count:
+        left, node.left = _split(node.left, count)
+        _update(node)
+        return left, node
+
+    node.right, right = _split(node.right, count - leftSize - 1)
+    _update(node)
+    return node, right
+
+
+def _merge(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+
+    right.left = _merge(left, right.left)
+    _update(right)
+    return right
+
+
+class IndexedList(object):
+    """A sequence with O(log n) positional insert, removal and lookup.
+
+    Implemented as an implicit treap whose nodes know their subtree sizes
+    and parents. `insert` returns the node holding the value, which can be
+    used with `indexOf` and `removeNode` to locate or drop the value
+    without a linear search.
+    """
+
+    def __init__(self, values=()):
+        self._root = None
+        for value in values:
+            self.append(value)
+
+    def __len__(self):
+        return _size(self._root)
+
+    def __iter__(self):
+        stack, node = [], self._root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.value
+            node = node.right
+
+    def _setRoot(self, node):
+        if node is not None:
+            node.parent = None
+        self._root = node
+
+    def _normalize(self, index):
+        length = len(self)
+        if index < 0:
+            index = index + length
+        if index < 0 or index >= length:
+            raise IndexError('IndexedList index out of range')
+        return index
+
+    def nodeAt(self, index):
+        index = self._normalize(index)
+
+        node = self._root
+        while True:
+            leftSize = _size(node.left)
+            if index < leftSize:
+                node = node.left
+            elif index == leftSize:
+                return node
+            else:
+                index = index - leftSize - 1
+                node = node.right
+
+    def __getitem__(self, index):
+        return self.nodeAt(index).value
+
+    def insert(self, index, value):
+        """Insert `value` before `index`, indices past the end append."""
+        index = max(0, min(index, len(self)))
+
+        node = _Node(value)
+        left, right = _split(self._root, index)
+        self._setRoot(_merge(_merge(left, node), right))
+        return node
+
+    def append(self, value):
+        return self.insert(len(self), value)
+
+    def pop(self, index):
+        index = self._normalize(index)
+
+        left, rest = _split(self._root, index)
+        node, right = _split(rest, 1)
+        self._setRoot(_merge(left, right))
+
+        node.parent = None
+        return node.value
+
+    def indexOf(self, node):
+        index = _size(node.left)
+        while node.parent is not None:
+            parent = node.parent
+            if node is parent.right:
+                index = index + _size(parent.left) + 1
+            node = parent
+        return index
+
+    def removeNode(self, node):
+        return self.pop(self.indexOf(node))
+
+    def clear(self):
+        self._root = None
@@ -1,27 +1,54 @@
-from decimal import Decimal
 from collections import deque
+from contextlib import contextmanager
 import gc
 from uuid import uuid4
-from operator import itemgetter
+from os import environ
 import json
 
 from twisted.internet import reactor
+from twisted.internet.defer import CancelledError
 from twisted.internet.task import deferLater
 from twisted.python import log
 
+from txplaya.clock import monotonic
 from txplaya.library import Library
 from txplaya.lastfm import getScrobbler
-from txplaya.track import Track
+from txplaya.loader import deferToLoader, loadLibraryTracks
+from txplaya.orderedlist import IndexedList
+from txplaya.scanjob import ScanManager
+from txplaya.watcher import LibraryWatcher, WATCH_LIBRARY
 
 ITER_TIME = 0.2
 HISTORY_CHUNKS = 4
+MAX_LATENESS = 1.0
+# weight of the latest tick in the recent lateness and chunk read time
+RECENT_WEIGHT = 0.2
+# seconds before the end of a track at which the next one is prepared
+PREFETCH_TIME = float(environ.get('TXPLAYA_PREFETCH_TIME', 10))
+# playlist undo steps kept, and the cap on tracks referenced by all of them
+UNDO_DEPTH = int(environ.get('TXPLAYA_UNDO_DEPTH', 100))
+UNDO_MAX_OPS = int(environ.get('TXPLAYA_UNDO_MAX_OPS', 100000))
 
 
-itemgetter0 = itemgetter(0)
+def _recent(average, value):
+    return average + RECENT_WEIGHT * (value - average)
+
 
 def logErr(failure):
     failure.printTraceback()
 
+def prepareTrack(track):
+    """Open the chunk source of `track` and warm its first read-ahead window.
+
+    Blocking, meant to run in a worker thread.
+    """
+    chunks = track.dataChunks(ITER_TIME)
+    if chunks is None:
+        raise IOError('{0} has no playable stream'.format(track.path))
+
+    chunks.prefetch()
+    return chunks
+
 
 class TxPlayaError(Exception): pass
 class PlaylistError(TxPlayaError): pass
@@ -29,15 +56,24 @@ class PlaylistFinished(PlaylistError): pass
 
 
 class ListenerRegistry(object):
+    """Listeners receiving pushed buffers.
 
-    def __init__(self):
+    With `batch` enabled, buffers broadcast during one reactor turn are
+    joined and handed to every listener in a single write.
+    """
+
+    def __init__(self, batch=False, clock=reactor):
         self._reg = {}
+        self._batch = batch
+        self._clock = clock
+        self._pending = []
+        self._flushCall = None
 
     def add(self, listener):
         self._reg[id(listener)] = listener
 
     def remove(self, listener):
-        del self._reg[id(listener)]
+        self._reg.pop(id(listener), None)
 
     def onPlaylistFinished(self):
         log.msg('ListenerRegistry::onPlaylistFinished not implemented')
@@ -46,6 +82,75 @@ class ListenerRegistry(object):
         for listener in self._reg.itervalues():
             yield listener
 
+    def broadcast(self, buf):
+        if not self._batch:
+            self._push(buf)
+            return
+
+        self._pending.append(buf)
+        if self._flushCall is None:
+            self._flushCall = self._clock.callLater(0, self._flush)
+
+    def _flush(self):
+        self._flushCall = None
+        if len(self._pending) == 1:
+            buf = self._pending[0]
+        else:
+            buf = ''.join(self._pending)
+        self._pending = []
+
+        self._push(buf)
+
+    def _push(self, buf):
+        for listenerId, listener in self._reg.items():
+            try:
+                listener.onPush(buf)
+            except Exception:
+                # one broken listener must not starve the others
+                log.err(None, 'Listener push failed, removing listener')
+                self._reg.pop(listenerId, None)
+
+
+class LatenessHistogram(object):
+    """Counts how late playback ticks fire, in milliseconds buckets."""
+
+    bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+        self.totalLateness = 0.0
+        self.maxLateness = 0.0
+        self.skipped = 0
+
+    def record(self, lateness):
+        ms = lateness * 1000
+        bucket = 0
+        while bucket < len(self.bounds) and ms > self.bounds[bucket]:
+            bucket = bucket + 1
+
+        self.counts[bucket] = self.counts[bucket] + 1
+        self.total = self.total + 1
+        self.totalLateness = self.totalLateness + lateness
+        self.maxLateness = max(self.maxLateness, lateness)
+
+    @property
+    def data(self):
+        labels = ['<=%dms' % bound for bound in self.bounds] + \
+                 ['>%dms' % self.bounds[-1]]
+        if self.total > 0:
+            mean = self.totalLateness * 1000 / self.total
+        else:
+            mean = 0
+        return {'buckets': zip(labels, self.counts),
+                'ticks': self.total,
+                'meanMs': mean,
+                'maxMs': self.maxLateness * 1000,
+                'skipped': self.skipped}
+
 
 class Player(object):
 
@@ -53,9 +158,16 @@ class Player(object):
     paused = False
     data = deque()
     history = deque()
-    currentSize = 0
 
     def __init__(self):
+        self.lateness = LatenessHistogram()
+        self.recentLateness = 0.0
+        self.recentReadTime = 0.0
+        self._clockStart = None
+        self._tick = 0
+        self._nextTick = None
+        self._endingSource = None
+
         self._garbageCollect()
 
     def _garbageCollect(self):
@@ -70,7 +182,7 @@ class Player(object):
 
     def feed(self, track, clear=False):
         if clear:
-            self.data.clear()
+            self._closeSources()
 
         try:
             chunks = track.dataChunks(ITER_TIME)
@@ -79,40 +191,124 @@ class Player(object):
             #self.onTrackFinished()
             raise
         else:
-            self.currentSize = sum(map(len, chunks))
-            self.data.extend(chunks)
+            if chunks is not None:
+                self.data.append(chunks)
+
+    def feedChunks(self, chunks, clear=False):
+        if clear:
+            self._closeSources()
+        self.data.append(chunks)
+
+    def enqueue(self, chunks):
+        self.data.append(chunks)
+
+    def dequeue(self, chunks):
+        if chunks in self.data:
+            self.data.remove(chunks)
+        chunks.close()
+
+    @property
+    def isEnding(self):
+        if len(self.data) == 0:
+            return False
+        source = self.data[0]
+        return source.length - source.elapsed <= PREFETCH_TIME
+
+    def _closeSources(self):
+        for chunks in self.data:
+            chunks.close()
+        self.data.clear()
+
+    def _nextChunk(self):
+        while len(self.data) > 0:
+            try:
+                return next(self.data[0])
+            except StopIteration:
+                self.data.popleft()
+                if len(self.data) > 0:
+                    # switch to the queued track within the same tick
+                    self.onTrackChanged()
+
+        return None
 
     def play(self):
         if not self.playing or self.paused:
             return
 
-        if len(self.data) == 0:
+        started = monotonic()
+        buf = self._nextChunk()
+        self.recentReadTime = _recent(self.recentReadTime, monotonic() - started)
+
+        if buf is None:
             self.playing = False
-            self.currentSize = 0
             self.onTrackFinished()
             return
 
-        buf = self.data.popleft()
-
         self.history.append(buf)
         while len(self.history) > HISTORY_CHUNKS:
             _ = self.history.popleft()
 
-        _d = deferLater(reactor, ITER_TIME, self.play)
-        _d.addErrback(logErr)
+        self._scheduleNext()
 
         # push buffer to management
         self.onPush(buf)
 
         self._timerUpdate()
 
+        if self.data[0] is not self._endingSource and self.isEnding:
+            self._endingSource = self.data[0]
+            self.onTrackEnding()
+
+    def _scheduleNext(self):
+        # ticks are due at fixed offsets from the clock start, so reactor
+        # latency delays a single tick instead of accumulating
+        now = monotonic()
+
+        if self._clockStart is None:
+            self._clockStart, self._tick = now, 0
+        else:
+            lateness = now - (self._clockStart + self._tick * ITER_TIME)
+            self.lateness.record(max(lateness, 0))
+            self.recentLateness = _recent(self.recentLateness, max(lateness, 0))
+
+            if lateness > MAX_LATENESS:
+                # too late to catch up, continue on a new time base
+                self.lateness.skipped = self.lateness.skipped + 1
+                self._clockStart, self._tick = now, 0
+
+        self._tick = self._tick + 1
+        delay = self._clockStart + self._tick * ITER_TIME - now
+
+        self._nextTick = deferLater(reactor, max(delay, 0), self.play)
+        self._nextTick.addErrback(self._onTickError)
+
+    def stress(self):
+        """(tick lateness, chunk read time) of the recent ticks, in seconds.
+
+        Zeros while nothing plays.
+        """
+        if not self.playing or self.paused:
+            return 0.0, 0.0
+        return self.recentLateness, self.recentReadTime
+
+    def _onTickError(self, failure):
+        if failure.check(CancelledError):
+            return
+        logErr(failure)
+
+    def _resetClock(self):
+        if self._nextTick is not None and not self._nextTick.called:
+            self._nextTick.cancel()
+        self._nextTick = None
+        self._clockStart = None
+
     def _timerUpdate(self):
-        if self.currentSize == 0:
+        if len(self.data) == 0 or self.data[0].length == 0:
             self.onTimerUpdate(0)
             return
 
-        remainingSize = sum(map(len, self.data))
-        progressPercent = int((self.currentSize - remainingSize ) * 100.0 / self.currentSize)
+        source = self.data[0]
+        progressPercent = int(source.elapsed * 100.0 / source.length)
 
         # update timer
         self.onTimerUpdate(progressPercent)
@@ -128,10 +324,12 @@ class Player(object):
 
         self.playing = True
         self.paused = False
+        self._resetClock()
         self.play()
 
     def stop(self):
-        self.data = deque()
+        self._resetClock()
+        self._closeSources()
         self.history = deque()
         self.playing = False
         self.paused = False
@@ -144,6 +342,7 @@ class Player(object):
 
     def resume(self):
         self.paused = False
+        self._resetClock()
         self.play()
         self.onPaused(False)
 
@@ -156,6 +355,12 @@ class Player(object):
     def onTrackFinished(self):
         log.err('Player not attached')
 
+    def onTrackEnding(self):
+        log.err('Player not attached')
+
+    def onTrackChanged(self):
+        log.err('Player not attached')
+
     def onStop(self):
         log.err('Player not attached')
 
@@ -166,20 +371,66 @@ class Player(object):
         log.err('Player not attached')
 
 
+class UndoStep(object):
+    """Operations undone together, `cost` counts the tracks they reference.
+
+    Operations are tuples, positions are the final positions:
+    ('insert', position, trackUid, track), ('remove', position, trackUid,
+    track), ('move', origin, target) and ('clear', [(trackUid, track)...]).
+    """
+
+    __slots__ = ('ops', 'cost')
+
+    def __init__(self):
+        self.ops = []
+        self.cost = 0
+
+    @staticmethod
+    def _opCost(op):
+        if op[0] == 'clear':
+            return len(op[1])
+        return 1
+
+    def append(self, op):
+        self.ops.append(op)
+        self.cost = self.cost + self._opCost(op)
+
+    def truncate(self, length):
+        """Drop and return the operations past `length`."""
+        dropped = self.ops[length:]
+        del self.ops[length:]
+        self.cost = self.cost - sum(self._opCost(op) for op in dropped)
+        return dropped
+
+
 class Playlist(object):
 
-    _reg = {}
-    _order = {}
     _currentUid = None
 
-    _undos = deque()
-    _redos = deque()
+    def __init__(self):
+        self._reg = {}
+        self._order = IndexedList()
+        self._nodes = {}
+
+        self._undos = deque()
+        self._redos = deque()
+        self._step = None
+        self._marked = False
+        self._groupDepth = 0
+        self._batchDepth = 0
+        self._batchChanged = False
+
+        # bumped on every change event, see popDelta
+        self.version = 0
+        self._changes = []
+
+        # tells apart the versions of every run of the server
+        self._epoch = uuid4().hex[:8]
+        # serialized snapshot, see snapshot
+        self._snapshot = None
 
     def iterTrackUid(self):
-        keys = sorted(self._order.keys())
-        for dposition in keys:
-            trackUid = self._order[dposition]
-            yield trackUid
+        return iter(self._order)
 
     def iterTrack(self):
         for trackUid in self.iterTrackUid():
@@ -187,62 +438,226 @@ class Playlist(object):
 
     @property
     def playlistData(self):
-        data = (track.meta for track in self.iterTrack())
-        data = [meta for meta in data if meta is not None]
-        return data
+        # tracks without tags keep their row so positions match the deltas
+        return [track.meta or {} for track in self.iterTrack()]
 
     @property
     def _paths(self):
         return [track._path for track in self.iterTrack()]
 
-    def insert(self, track, position=None, emit=True):
-        if self._reg == {}:
-            dposition = Decimal(1)
+    # primitive operations, recorded in the open undo step
 
-        elif position is None or position >= len(self._order):
-            dposition = max(self._order.keys()) + 1
+    def _record(self, op):
+        self._changes.append(op)
+        if self._marked:
+            self._openStep()
+        if self._step is not None:
+            self._step.append(op)
 
-        elif position == 0:
-            dposition = min(self._order.keys()) / 2
+    def _insertAt(self, position, trackUid, track):
+        position = max(0, min(position, len(self._order)))
+        self._reg[trackUid] = track
+        self._nodes[trackUid] = self._order.insert(position, trackUid)
+        self._record(('insert', position, trackUid, track))
 
-        else: # 0 < position < len_reg
-            keys = sorted(self._order.keys())
-            dposition = (keys[position - 1] + keys[position]) / 2
+    def _removeAt(self, position):
+        trackUid = self._order[position]
+        position = self._order.indexOf(self._nodes[trackUid])
 
-        trackUid = uuid4()
-        self._reg[trackUid] = track
-        self._order[dposition] = trackUid
+        self._order.removeNode(self._nodes.pop(trackUid))
+        track = self._reg.pop(trackUid)
+
+        if trackUid == self._currentUid:
+            self._currentUid = None
+
+        self._record(('remove', position, trackUid, track))
+
+    def _moveTo(self, origin, target):
+        trackUid = self._order[origin]
+        origin = self._order.indexOf(self._nodes[trackUid])
+        self._order.removeNode(self._nodes[trackUid])
+        self._nodes[trackUid] = self._order.insert(target, trackUid)
+        self._record(('move', origin, target))
+
+    def _clearAll(self):
+        entries = [(trackUid, self._reg[trackUid]) for trackUid in self._order]
+
+        self._order = IndexedList()
+        self._nodes = {}
+        self._reg = {}
+        self._currentUid = None
+
+        self._record(('clear', entries))
+
+    def _apply(self, op):
+        kind = op[0]
+        if kind == 'insert':
+            self._insertAt(op[1], op[2], op[3])
+        elif kind == 'remove':
+            self._removeAt(op[1])
+        elif kind == 'move':
+            self._moveTo(op[1], op[2])
+        else:
+            self._clearAll()
+
+    def _applyInverse(self, op):
+        kind = op[0]
+        if kind == 'insert':
+            self._removeAt(op[1])
+        elif kind == 'remove':
+            self._insertAt(op[1], op[2], op[3])
+        elif kind == 'move':
+            self._moveTo(op[2], op[1])
+        else:
+            for trackUid, track in op[1]:
+                self._insertAt(len(self._order), trackUid, track)
+
+    def insert(self, track, position=None, emit=True):
+        if position is None:
+            position = len(self._order)
+
+        self._insertAt(position, uuid4(), track)
 
         if emit:
-            self.onChanged()
+            self._emitChanged()
 
     def mark(self):
-        self._undos.append((dict(self._reg), dict(self._order)))
+        """Start a new undo step, unless inside a group.
+
+        The step is opened by the first change recorded after the mark, an
+        operation that fails before changing anything leaves no step.
+        """
+        if self._groupDepth > 0 and self._step is not None:
+            return
+
+        self._step = None
+        self._marked = True
+
+    def _openStep(self):
+        self._marked = False
+        self._step = UndoStep()
+        self._undos.append(self._step)
         self._redos.clear()
 
+        self._trimUndos()
+
+    def _trimUndos(self):
+        cost = sum(step.cost for step in self._undos)
+        while len(self._undos) > 1 and (len(self._undos) > UNDO_DEPTH or cost > UNDO_MAX_OPS):
+            cost = cost - self._undos.popleft().cost
+
+    @contextmanager
+    def group(self):
+        """Record all changes made inside the block as one undo step."""
+        if self._groupDepth == 0:
+            self.mark()
+        self._groupDepth = self._groupDepth + 1
+        try:
+            yield self
+        finally:
+            self._groupDepth = self._groupDepth - 1
+
+    @contextmanager
+    def batch(self):
+        """Apply several changes as one undo step and one change event.
+
+        If the block raises, its changes are rolled back.
+        """
+        with self.group():
+            step, marked = self._step, self._marked
+            start = len(step.ops) if step is not None else 0
+            self._batchDepth = self._batchDepth + 1
+            try:
+                yield self
+            except Exception:
+                opened = self._step
+                if opened is step:
+                    dropped = step.truncate(start) if step is not None else []
+                else:
+                    # the step was opened inside this batch, drop it
+                    dropped = opened.ops
+                    self._undos.remove(opened)
+
+                self._step, self._marked = None, False
+                for op in reversed(dropped):
+                    self._applyInverse(op)
+                self._step, self._marked = step, marked
+                raise
+            finally:
+                self._batchDepth = self._batchDepth - 1
+                if self._batchDepth == 0 and self._batchChanged:
+                    self._batchChanged = False
+                    self.onChanged()
+
+    def popDelta(self):
+        """Bump the version and return the changes made since the last call.
+
+        Runs of inserts and removals are joined: ['insert', position,
+        [meta, ...]], ['remove', position, count], ['move', origin, target]
+        and ['clear']. Positions are the ones at the time of each change.
+        """
+        self.version = self.version + 1
+        changes, self._changes = self._changes, []
+
+        delta = []
+        for op in changes:
+            kind = op[0]
+            last = delta[-1] if len(delta) > 0 else None
+
+            if kind == 'insert':
+                meta = op[3].meta or {}
+                if last is not None and last[0] == 'insert' \
+                        and last[1] + len(last[2]) == op[1]:
+                    last[2].append(meta)
+                else:
+                    delta.append(['insert', op[1], [meta]])
+
+            elif kind == 'remove':
+                if last is not None and last[0] == 'remove' and last[1] == op[1]:
+                    last[2] = last[2] + 1
+                elif last is not None and last[0] == 'remove' and last[1] == op[1] + 1:
+                    last[1] = op[1]
+                    last[2] = last[2] + 1
+                else:
+                    delta.append(['remove', op[1], 1])
+
+            elif kind == 'move':
+                delta.append(['move', op[1], op[2]])
+
+            else:
+                delta = [['clear']]
+
+        return delta
+
+    def _emitChanged(self):
+        if self._batchDepth > 0:
+            self._batchChanged = True
+        else:
+            self.onChanged()
+
     def undo(self):
         if not self.hasUndo:
             return
 
-        self._redos.appendleft((dict(self._reg), dict(self._order)))
-        self._reg, self._order = self._undos.pop()
-
-        if self._currentUid not in self._reg:
-            self._currentUid = None
+        self._step, self._marked = None, False
+        step = self._undos.pop()
+        for op in reversed(step.ops):
+            self._applyInverse(op)
+        self._redos.appendleft(step)
 
-        self.onChanged()
+        self._emitChanged()
 
     def redo(self):
         if not self.hasRedo:
             return
 
-        self._undos.append((dict(self._reg), dict(self._order)))
-        self._reg, self._order = self._redos.popleft()
+        self._step, self._marked = None, False
+        step = self._redos.popleft()
+        for op in step.ops:
+            self._apply(op)
+        self._undos.append(step)
 
-        if self._currentUid not in self._reg:
-            self._currentUid = None
-
-        self.onChanged()
+        self._emitChanged()
 
     @property
     def hasUndo(self):
@@ -251,66 +666,107 @@ class Playlist(object):
     def hasRedo(self):
         return len(self._redos) > 0
 
-    def remove(self, position, emit=True):
-        keys = sorted(self._order.keys())
-        dposition = keys[position]
-        trackUid = self._order[dposition]
+    @property
+    def epoch(self):
+        return self._epoch
+
+    def snapshotData(self):
+        return {'playlist': self.playlistData,
+                'epoch': self._epoch,
+                'version': self.version,
+                'position': self.currentPosition,
+                'hasUndo': self.hasUndo,
+                'hasRedo': self.hasRedo}
+
+    def snapshot(self):
+        """Serialized snapshot data, its infostream event line and ETag.
+
+        Serialized once and reused until the playlist, its undo state or
+        the current position change. Changes made without a change event
+        get their event first, so the snapshot is not served under the
+        version the next delta starts from.
+        """
+        if len(self._changes) > 0 and self._batchDepth == 0:
+            self.onChanged()
 
-        self.mark()
+        # changes are only appended to between versions
+        key = (self.version, len(self._changes), self.hasUndo, self.hasRedo,
+               self.currentPosition)
 
-        del self._order[dposition]
-        del self._reg[trackUid]
+        if self._snapshot is None or self._snapshot[0] != key:
+            body = json.dumps(self.snapshotData()).encode('utf-8')
+            line = '{"event": "PlaylistChanged", "data": ' + body + '}\n'
+            etag = '"%s.%d.%d.%d%d.%s"' % ((self._epoch,) + key)
+            self._snapshot = (key, body, line, etag)
 
-        if trackUid == self._currentUid:
-            self._currentUid = None
+        return self._snapshot[1:]
+
+    def _checkPosition(self, position):
+        if not -len(self._order) <= position < len(self._order):
+            raise IndexError('playlist position out of range')
+
+    def remove(self, position, emit=True):
+        self._checkPosition(position)
+
+        self.mark()
+        self._removeAt(position)
 
         if emit:
-            self.onChanged()
+            self._emitChanged()
 
     def move(self, origin, target, emit=True):
-        if origin == target or origin + 1 == target:
-            return
+        """Move the track at `origin` in front of the one at `target`.
 
-        keys = sorted(self._order.keys())
-        dpositionOrigin = keys[origin]
-        trackUid = self._order[dpositionOrigin]
+        `target` may be the playlist length, to move the track to the end.
+        Negative positions count from the end.
+        """
+        self._checkPosition(origin)
+        if not -len(self._order) <= target <= len(self._order):
+            raise IndexError('playlist position out of range')
 
-        if target == 0:
-            dpositionTarget = keys[0] / 2
-        elif target >= len(self._order):
-            dpositionTarget = max(self._order.keys()) + 1
-        else:
-            dpositionTarget = (keys[target] + keys[target - 1]) / 2
+        if origin < 0:
+            origin = origin + len(self._order)
+        if target < 0:
+            target = target + len(self._order)
+
+        if origin == target or origin + 1 == target:
+            return
 
         self.mark()
 
-        del self._order[dpositionOrigin]
-        self._order[dpositionTarget] = trackUid
+        # target is counted before the track is taken out
+        if target > origin:
+            target = target - 1
+        self._moveTo(origin, target)
 
         if emit:
-            self.onChanged()
+            self._emitChanged()
 
     def clear(self):
         self.mark()
+        self._clearAll()
 
-        self._order.clear()
-        self._reg.clear()
-        self._currentUid = None
-
-        self.onChanged()
+        self._emitChanged()
 
     @property
     def currentPosition(self):
         if self._currentUid is None:
             return None
 
-        keys = sorted(self._order.items(), key=itemgetter0)
+        position = self.positionOf(self._currentUid)
+        if position is None:
+            raise PlaylistError, 'current uid not in _reg'
+
+        return position
 
-        for position, (_, trackUid) in enumerate(keys):
-            if trackUid == self._currentUid:
-                return position
+    def uidAt(self, position):
+        return self._order[position]
 
-        raise PlaylistError, 'current uid not in _reg'
+    def positionOf(self, trackUid):
+        node = self._nodes.get(trackUid)
+        if node is None:
+            return None
+        return self._order.indexOf(node)
 
     @property
     def currentTrack(self):
@@ -328,10 +784,7 @@ class Playlist(object):
         if position is None:
             position = 0
 
-        keys = sorted(self._order.keys())
-        dposition = keys[position]
-        trackUid = self._order[dposition]
-        self._currentUid = trackUid
+        self._currentUid = self._order[position]
 
     def stop(self):
         self._currentUid = None
@@ -371,15 +824,25 @@ class MainController(object):
     def __init__(self):
         self.player = Player()
         self.playlist = Playlist()
-        self.listenerRegistry = ListenerRegistry()
+        self.listenerRegistry = ListenerRegistry(batch=True)
         self.infoListenerRegistry = ListenerRegistry()
         self.library = Library()
+        self.scanManager = ScanManager(self.library, self.announce, self.player.stress)
 
         self.scrobbler = getScrobbler()
 
+        self._prefetchToken = None
+        self._prefetchUid = None
+        self._prefetchSource = None
+        self._startWhenReady = False
+        self._restored = False
+        self.watcher = None
+
         self.player.onPush = self.onBufferReceived
         self.player.onStart = self.onPlaybackStarted
         self.player.onTrackFinished = self.onTrackFinished
+        self.player.onTrackEnding = self.onTrackEnding
+        self.player.onTrackChanged = self.onTrackChanged
         self.player.onStop = self.onPlayerStopped
         self.player.onTimerUpdate = self.onTimerUpdate
         self.player.onPaused = self.onPlayerPaused
@@ -390,51 +853,151 @@ class MainController(object):
 
         filepaths = playlistRegistry.loadPlaylist('__current__')
 
-        for filepath in filepaths:
-            if not self.library.pathExists(filepath):
-                continue
-            track = Track(filepath)
-            self.playlist.insert(track)
+        d = loadLibraryTracks(self.library, filepaths)
+        d.addCallback(self._onCurrentLoaded)
+        d.addErrback(logErr)
+
+        if WATCH_LIBRARY:
+            self.watcher = LibraryWatcher(self.library, self.onLibraryChanged)
+            self.watcher.start()
+
+        self.scanManager.resumeInterrupted()
+
+    def _onCurrentLoaded(self, tracks):
+        for track in tracks:
+            self.playlist.insert(track, emit=False)
+        self.playlist.onChanged()
+        self._restored = True
 
     def onStop(self):
         from txplaya.playlistregistry import playlistRegistry
 
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+        if not self._restored:
+            # do not overwrite the saved playlist before it was loaded back
+            return
+
         paths = [track._path for track in self.playlist.iterTrack()]
         playlistRegistry.savePlaylist('__current__', paths)
 
+    def onLibraryChanged(self, delta):
+        event = {'event': 'LibraryChanged',
+                 'data': delta}
+        self.announce(event)
+
     def announce(self, data):
         buf = (json.dumps(data) + '\n').encode('utf-8')
-        for listener in self.infoListenerRegistry.iterListeners():
-            deferLater(reactor, 0, listener.onPush, buf)
+        self.infoListenerRegistry.broadcast(buf)
 
-    def onTrackFinished(self):
-        if self.scrobbler is not None:
-            deferLater(reactor, 0, self.scrobbler.scrobble, self.playlist.currentTrack)
+    def _nextUid(self):
+        position = self.playlist.currentPosition
+        if position is None or position + 1 >= len(self.playlist._reg):
+            return None
+        return self.playlist.uidAt(position + 1)
+
+    def prefetchNext(self):
+        """Prepare the next playlist entry in a worker thread."""
+        trackUid = self._nextUid()
+        if trackUid is None:
+            return False
+
+        token = object()
+        self._prefetchToken = token
+        self._prefetchUid = trackUid
+        self._prefetchSource = None
+
+        track = self.playlist._reg[trackUid]
+        d = deferToLoader(prepareTrack, track)
+        d.addCallbacks(self._onPrefetched, self._onPrefetchFailed,
+                       callbackArgs=(token,), errbackArgs=(token,))
+        d.addErrback(logErr)
+        return True
+
+    def resetPrefetch(self):
+        if self._prefetchSource is not None:
+            self.player.dequeue(self._prefetchSource)
+
+        self._prefetchToken = None
+        self._prefetchUid = None
+        self._prefetchSource = None
+        self._startWhenReady = False
+
+    def _onPrefetched(self, chunks, token):
+        if token is not self._prefetchToken:
+            # superseded while loading
+            chunks.close()
+            return
 
-        if self.playlist.stepNext() is None:
-            self.onPlaylistFinished()
+        trackUid = self._prefetchUid
+
+        self._prefetchSource = chunks
+        self.player.enqueue(chunks)
+
+        if self._startWhenReady:
+            # the previous track already ran out, start right away
+            self._startWhenReady = False
+            self._scrobbleCurrent()
+            self._prefetchToken = self._prefetchUid = self._prefetchSource = None
+            self.playlist.start(self.playlist.positionOf(trackUid))
+            self.player.start()
+
+    def _onPrefetchFailed(self, failure, token):
+        if token is not self._prefetchToken:
             return
 
-        while True:
-            try:
-                self.player.feed(self.playlist.currentTrack, clear=False)
-            except IOError:
-                # next track not found on disk
-                currentPosition = self.playlist.currentPosition
-                self.playlist.remove(currentPosition, emit=False)
-
-                if currentPosition >= len(self.playlist._reg):
-                    # no more tracks
-                    self.onPlaylistFinished()
-                    break
-                else:
-                    # try next
-                    self.playlist.start(currentPosition)
-            else:
-                # track loaded successfuly
-                self.player.start()
-                self.onPlaybackStarted()
-                break
+        if failure.check(IOError, OSError):
+            log.msg('Next track can not be read: %s' % failure.getErrorMessage())
+        else:
+            log.err(failure, 'Next track can not be played')
+
+        # drop the broken entry and move on to the one after it
+        trackUid = self._prefetchUid
+        self._prefetchToken = self._prefetchUid = None
+
+        position = self.playlist.positionOf(trackUid)
+        if position is not None:
+            self.playlist.remove(position)
+
+        if not self.prefetchNext() and self._startWhenReady:
+            self._finishPlaylist()
+
+    def _scrobbleCurrent(self):
+        track = self.playlist.currentTrack
+        if self.scrobbler is not None and track is not None:
+            deferLater(reactor, 0, self.scrobbler.scrobble, track)
+
+    def onTrackEnding(self):
+        if self._prefetchUid is None:
+            self.prefetchNext()
+
+    def onTrackChanged(self):
+        self._scrobbleCurrent()
+
+        trackUid = self._prefetchUid
+        self._prefetchToken = self._prefetchUid = self._prefetchSource = None
+
+        if trackUid is None:
+            self.playlist.stepNext()
+        else:
+            self.playlist.start(self.playlist.positionOf(trackUid))
+        self.onPlaybackStarted()
+
+    def onTrackFinished(self):
+        # the next track was not ready in time, it starts once prepared
+        if self._prefetchUid is not None or self.prefetchNext():
+            self._startWhenReady = True
+            return
+
+        self._finishPlaylist()
+
+    def _finishPlaylist(self):
+        self._startWhenReady = False
+        self._scrobbleCurrent()
+        self.playlist.stop()
+        self.onPlaylistFinished()
 
     def onPlaybackStarted(self):
         track = self.playlist.currentTrack
@@ -472,13 +1035,35 @@ class MainController(object):
 
     def onBufferReceived(self, buf):
         # deliver buffer to all listeners
-        for listener in self.listenerRegistry.iterListeners():
-            _d = deferLater(reactor, 0, listener.onPush, buf)
+        self.listenerRegistry.broadcast(buf)
 
     def onPlaylistChange(self):
+        if self._prefetchUid is not None and self._prefetchUid != self._nextUid():
+            # the prepared track is no longer next in line
+            startWhenReady = self._startWhenReady
+            self.resetPrefetch()
+
+            if startWhenReady or self.player.isEnding:
+                if self.prefetchNext():
+                    self._startWhenReady = startWhenReady
+                elif startWhenReady:
+                    self._finishPlaylist()
+
         playlist = self.playlist
-        event = {'event': 'PlaylistChanged',
-                 'data': {'playlist': playlist.playlistData,
+        delta = playlist.popDelta()
+
+        deltaSize = sum(len(op[2]) if op[0] == 'insert' else 1 for op in delta)
+        if deltaSize > len(playlist._reg):
+            # rebuilt from scratch, a snapshot is smaller
+            _, line, _ = playlist.snapshot()
+            self.infoListenerRegistry.broadcast(line)
+            return
+
+        event = {'event': 'PlaylistDelta',
+                 'data': {'epoch': playlist.epoch,
+                          'base': playlist.version - 1,
+                          'version': playlist.version,
+                          'ops': delta,
                           'hasUndo': playlist.hasUndo,
                           'hasRedo': playlist.hasRedo,
                           'position': playlist.currentPosition}}
@@ -3,6 +3,8 @@ from os.path import join as path_join
 from os import environ
 from zlib import compress, decompress
 from base64 import b64encode, b64decode
+from uuid import uuid4
+import json
 import pickle
 
 if 'TXPLAYA_PLAYLISTS' in environ:
@@ -17,11 +19,19 @@ BINPATH = path_join(dirname(dirname(__file__)), '.playlists')
 class PlaylistRegistry(object):
 
     def __init__(self):
+        self.version = 0
+        self._epoch = uuid4().hex[:8]
+        self._listCache = None
+
         try:
             self.load()
         except Exception:
             self._reg = {}
 
+    def _changed(self):
+        self.version = self.version + 1
+        self._listCache = None
+
     def load(self):
         with open(BINPATH, 'rb') as f:
             content = f.read()
@@ -42,8 +52,19 @@ class PlaylistRegistry(object):
         names.sort()
         return names
 
+    def listSerialized(self):
+        """Serialized name list, its infostream event line and ETag."""
+        if self._listCache is None:
+            body = json.dumps({'list': self.list_()}).encode('utf-8')
+            line = '{"event": "PlaylistRegistryUpdated", "data": ' + body + '}\n'
+            etag = '"%s.%d"' % (self._epoch, self.version)
+            self._listCache = (body, line, etag)
+
+        return self._listCache
+
     def savePlaylist(self, name, trackPaths):
         self._reg[name] = map(b64encode, trackPaths)
+        self._changed()
         self.save()
 
     def loadPlaylist(self, name):
@@ -59,6 +80,7 @@ class PlaylistRegistry(object):
         except KeyError:
             pass
         else:
+            self._changed()
             self.save()
 
 playlistRegistry = PlaylistRegistry()
@@ -23,6 +23,10 @@ url_map = Map([
     Rule('/playlist/library/insert/<string:trackIds>',
          defaults={'action': 'libraryInsert'},
          endpoint=controllers.PlaylistManager),
+    Rule('/playlist/batch', defaults={'action': 'batch'}, methods=['POST'],
+         endpoint=controllers.PlaylistManager),
+    Rule('/playlists', defaults={'action': 'list_'},
+         endpoint=controllers.PlaylistManager),
     Rule('/playlist/save/<string:playlistName>', defaults={'action': 'save'},
          endpoint=controllers.PlaylistManager),
     Rule('/playlist/load/<string:playlistName>', defaults={'action': 'load'},
@@ -45,10 +49,32 @@ url_map = Map([
          endpoint=controllers.Player),
     Rule('/player/pause', defaults={'action': 'pause'},
          endpoint=controllers.Player),
+    Rule('/player/stats', defaults={'action': 'stats'},
+         endpoint=controllers.Player),
     Rule('/library', defaults={'action': 'getLibrary'},
          endpoint=controllers.Library),
+    Rule('/library/search', defaults={'action': 'search'},
+         endpoint=controllers.Library),
+    Rule('/library/artists', defaults={'action': 'artists'},
+         endpoint=controllers.Library),
+    Rule('/library/artists/<string:artistId>/albums', defaults={'action': 'albums'},
+         endpoint=controllers.Library),
+    Rule('/library/albums/<string:albumId>/tracks', defaults={'action': 'albumTracks'},
+         endpoint=controllers.Library),
     Rule('/library/rescan', defaults={'action': 'rescan'},
          endpoint=controllers.Library),
+    Rule('/library/rescan/full', defaults={'action': 'rescanFull'},
+         endpoint=controllers.Library),
+    Rule('/library/scan', defaults={'action': 'scanStatus'},
+         endpoint=controllers.Library),
+    Rule('/library/scan/start', defaults={'action': 'scanStart'},
+         endpoint=controllers.Library),
+    Rule('/library/scan/start/full', defaults={'action': 'scanStartFull'},
+         endpoint=controllers.Library),
+    Rule('/library/scan/cancel', defaults={'action': 'scanCancel'},
+         endpoint=controllers.Library),
+    Rule('/library/scan/resume', defaults={'action': 'scanResume'},
+         endpoint=controllers.Library),
     Rule('/infostream',
          endpoint=controllers.InfoStream)
 ])
@@ -0,0 +1,255 @@
+from collections import deque
+from os import environ
+
+from twisted.internet.defer import Deferred
+from twisted.python import log
+
+from txplaya.clock import monotonic
+from txplaya.loader import deferToLoader
+from txplaya.scanner import Scanner, ScanThrottle, walkLibrary
+
+# seconds between ScanProgress events on the infostream
+SCAN_EVENT_INTERVAL = float(environ.get('TXPLAYA_SCAN_EVENT_INTERVAL', 1.0))
+# seconds of progress the scan rate is measured over
+SCAN_RATE_WINDOW = 10.0
+
+_RUNNING = ('walking', 'scanning', 'applying')
+
+
+class ScanJob(object):
+    """A library rescan running apart from the request that started it.
+
+    The job walks the library, then scans it, then applies the staged
+    scan to the index; it ends finished, cancelled or failed. `onEvent`
+    gets the ScanProgress and ScanFinished events of the infostream.
+    Functions added with `listen` get the progress in percents, the
+    Deferreds of `whenDone` fire with the final status. `stress` gives
+    the playback stress the scan backs off from, see ScanThrottle.
+    """
+
+    def __init__(self, library, full=False, resume=False, onEvent=None, stress=None):
+        self.library = library
+        self.full = full
+        self.resumed = resume
+        self.onEvent = onEvent
+        self.throttle = ScanThrottle(stress=stress)
+        self.counts = None
+        self.error = None
+
+        self._state = 'walking'
+        self._scanner = None
+        self._started = monotonic()
+        self._ended = None
+        self._samples = deque()
+        self._lastEvent = 0
+        self._listeners = []
+        self._waiting = []
+
+    @property
+    def state(self):
+        if self._state == 'scanning' and self._scanner.applying:
+            return 'applying'
+        return self._state
+
+    @property
+    def running(self):
+        return self.state in _RUNNING
+
+    def start(self):
+        if self.resumed:
+            self.full = self.library.resumeScan()
+        else:
+            self.library.beginScan(self.full)
+
+        log.msg('Rescan %s' % ('resumed' if self.resumed else 'started'))
+        self._announce('ScanProgress')
+
+        d = deferToLoader(walkLibrary, self.library)
+        d.addCallback(self._scan)
+        d.addCallbacks(self._onFinished, self._onFailed)
+
+    def _scan(self, dirs):
+        if self._state != 'walking':
+            # cancelled while walking
+            return None
+
+        self._state = 'scanning'
+        self._scanner = Scanner(self.library, dirs, self._onProgress, throttle=self.throttle)
+        self._samples.append((monotonic(), 0))
+        return self._scanner.start()
+
+    def cancel(self):
+        """Stop the job, the scan is kept for a resume.
+
+        Returns False when the job is past the point it can be cancelled.
+        """
+        if self.state not in ('walking', 'scanning'):
+            return False
+
+        self._state = 'cancelled'
+        if self._scanner is not None:
+            self._scanner.stop()
+        self.library.cancelScan()
+        self._end()
+        return True
+
+    def listen(self, onProgress):
+        self._listeners.append(onProgress)
+
+    def whenDone(self):
+        d = Deferred()
+        if self.running:
+            self._waiting.append(d)
+        else:
+            d.callback(self.status())
+        return d
+
+    def _onProgress(self, progress):
+        now = monotonic()
+        self._samples.append((now, self._scanner.files))
+        while len(self._samples) > 2 and now - self._samples[0][0] > SCAN_RATE_WINDOW:
+            self._samples.popleft()
+
+        for onProgress in self._listeners:
+            onProgress(progress)
+
+        if now - self._lastEvent >= SCAN_EVENT_INTERVAL:
+            self._announce('ScanProgress')
+
+    def _onFinished(self, counts):
+        if counts is None:
+            # stopped by cancel
+            return
+
+        self._state = 'finished'
+        self.counts = counts
+
+        log.msg('Rescan finished in %d seconds.' % int(monotonic() - self._started))
+        log.msg('Total tracks: %d, added %d, updated %d, removed %d, skipped %d' % (
+            len(self.library), counts['added'], counts['updated'], counts['removed'],
+            counts['skipped']))
+        self._end()
+
+    def _onFailed(self, failure):
+        log.err(failure)
+        if not self.running:
+            return
+
+        self._state = 'failed'
+        self.error = failure.getErrorMessage()
+        if self._scanner is not None:
+            self._scanner.stop()
+        # not resumed on its own, it would likely fail again
+        self.library.cancelScan()
+        self._end()
+
+    def _end(self):
+        self._ended = monotonic()
+        status = self.status()
+        self._announce('ScanFinished', status)
+
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(status)
+
+    def _announce(self, event, status=None):
+        self._lastEvent = monotonic()
+        if self.onEvent is not None:
+            self.onEvent({'event': event,
+                          'data': status or self.status()})
+
+    def rate(self):
+        """Files done per second lately, None before there is a measure."""
+        if len(self._samples) < 2:
+            return None
+
+        (startTime, startFiles), (endTime, endFiles) = self._samples[0], self._samples[-1]
+        if endTime <= startTime:
+            return None
+        return (endFiles - startFiles) / (endTime - startTime)
+
+    def status(self):
+        state = self.state
+        end = self._ended if self._ended is not None else monotonic()
+        status = {'state': state,
+                  'full': self.full,
+                  'resumed': self.resumed,
+                  'elapsed': round(end - self._started, 1)}
+
+        scanner = self._scanner
+        if scanner is not None:
+            status['files'] = scanner.files
+            status['total'] = scanner.filesTotal
+            status['progress'] = scanner.progress
+
+        if state == 'scanning':
+            rate = self.rate()
+            status['filesPerSec'] = None if rate is None else round(rate, 1)
+            status['backoff'] = self.throttle.backoff
+            status['eta'] = None
+            if rate:
+                status['eta'] = int((scanner.filesTotal - scanner.files) / rate)
+
+        if self.counts is not None:
+            status.update(self.counts)
+            status['version'] = self.library.version
+        if self.error is not None:
+            status['error'] = self.error
+
+        return status
+
+
+class ScanManager(object):
+    """Runs the library rescans, one job at a time.
+
+    Asking for a rescan while one runs gives the running job. A scan left
+    unfinished by a stop of the server is resumed by resumeInterrupted, a
+    cancelled one waits for `resume`.
+    """
+
+    def __init__(self, library, onEvent=None, stress=None):
+        self.library = library
+        self.onEvent = onEvent
+        self.stress = stress
+        self.job = None
+
+    @property
+    def running(self):
+        return self.job is not None and self.job.running
+
+    def start(self, full=False):
+        """The running job, a new one if none runs."""
+        if not self.running:
+            self.job = ScanJob(self.library, full, onEvent=self.onEvent, stress=self.stress)
+            self.job.start()
+        return self.job
+
+    def resume(self):
+        """The running job, or the unfinished scan resumed, None if there is none."""
+        if self.running:
+            return self.job
+        if self.library.scanCheckpoint() is None:
+            return None
+
+        self.job = ScanJob(self.library, resume=True, onEvent=self.onEvent,
+                           stress=self.stress)
+        self.job.start()
+        return self.job
+
+    def resumeInterrupted(self):
+        checkpoint = self.library.scanCheckpoint()
+        if checkpoint is not None and not checkpoint[1]:
+            self.resume()
+
+    def cancel(self):
+        """Whether there was a running job to cancel."""
+        return self.running and self.job.cancel()
+
+    def status(self):
+        if self.job is not None:
+            status = self.job.status()
+        else:
+            status = {'state': 'idle'}
+
+        status['resumable'] = not self.running and self.library.scanCheckpoint() is not None
+        return status
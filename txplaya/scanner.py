@@ -0,0 +1,317 @@
+from multiprocessing import Event, Pool, cpu_count
+from os import environ, nice
+import signal
+import sys
+import traceback
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from txplaya.clock import monotonic
+from txplaya.iohints import IOPRIO_CLASS_IDLE, dropCache, lowIoPriority, setIoPriority
+from txplaya.library import readMeta
+from txplaya.loader import deferToLoader
+
+# worker processes parsing tags during a rescan
+SCAN_WORKERS = int(environ.get('TXPLAYA_SCAN_WORKERS', cpu_count()))
+# files handed to a worker at once
+SCAN_BATCH = int(environ.get('TXPLAYA_SCAN_BATCH', 32))
+# files checked per second at most, 0 for no limit
+SCAN_RATE = float(environ.get('TXPLAYA_SCAN_RATE', 1000))
+# recent playback tick lateness and chunk read time, in seconds, that pause a rescan
+SCAN_MAX_LATENESS = float(environ.get('TXPLAYA_SCAN_MAX_LATENESS', 0.05))
+SCAN_MAX_READ_TIME = float(environ.get('TXPLAYA_SCAN_MAX_READ_TIME', 0.02))
+# shortest and longest pause of a rescan backing off, in seconds
+SCAN_BACKOFF_MIN = 0.25
+SCAN_BACKOFF_MAX = 8.0
+# batches handed to every worker ahead, a pause stops the reads after them
+SCAN_AHEAD = 2
+
+# apply_async of python 2 has no error_callback, a failed task is dropped
+_HAS_ERROR_CALLBACK = sys.version_info[0] >= 3
+
+
+class ScanError(Exception): pass
+
+
+# set in worker processes when the scan is stopped
+_stopped = None
+
+
+def _initWorker(stopped):
+    global _stopped
+
+    # interrupts are handled by the server, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _stopped = stopped
+
+    # playback comes first, for the disk and the processor
+    setIoPriority(IOPRIO_CLASS_IDLE)
+    nice(10)
+
+
+def parseBatch(batch):
+    """Tags of the (path, stat) pairs in `batch`, runs in a worker process."""
+    results = []
+    for path_, stat_ in batch:
+        if _stopped is not None and _stopped.is_set():
+            break
+
+        try:
+            meta = readMeta(path_)
+        except Exception:
+            meta = None
+        results.append((path_, stat_, meta))
+
+        # files are read once, the tracks played should stay in the cache
+        dropCache(path_)
+
+    return results
+
+
+def tryParseBatch(batch):
+    """parseBatch giving (True, results), or (False, (error, traceback)) if it raises."""
+    try:
+        return True, parseBatch(batch)
+    except Exception, err:
+        return False, (repr(err), traceback.format_exc())
+
+
+def walkLibrary(library):
+    """Directories of the library with their files, see Library.scanDirs."""
+    with lowIoPriority():
+        return library.scanDirs()
+
+
+class ScanThrottle(object):
+    """Paces a rescan so that playback gets to the disk first.
+
+    At most `rate` files are let through a second, as many as come when it
+    is 0. While `stress` reports the playback ticks late or the chunk
+    reads slow, the scan pauses, twice as long every time the stress is
+    still there, see Player.stress.
+    """
+
+    def __init__(self, rate=SCAN_RATE, stress=None):
+        self.rate = rate
+        self.stress = stress
+        self.backoff = 0.0
+        self._next = monotonic()
+
+    def isStressed(self):
+        if self.stress is None:
+            return False
+
+        lateness, readTime = self.stress()
+        return lateness > SCAN_MAX_LATENESS or readTime > SCAN_MAX_READ_TIME
+
+    def pause(self):
+        """Seconds all reads of the scan should pause for playback, 0 for none."""
+        if self.isStressed():
+            self.backoff = min(max(self.backoff * 2, SCAN_BACKOFF_MIN), SCAN_BACKOFF_MAX)
+            return self.backoff
+
+        # eased off, a stress coming back soon starts from a longer pause
+        self.backoff = self.backoff / 2 if self.backoff >= 2 * SCAN_BACKOFF_MIN else 0.0
+        return 0.0
+
+    def wait(self):
+        """Seconds to wait before more files are checked, for the rate."""
+        return max(0.0, self._next - monotonic())
+
+    def consume(self, files):
+        """Count `files` let through against the rate."""
+        if self.rate > 0:
+            self._next = max(self._next, monotonic()) + files / self.rate
+
+
+class Scanner(object):
+    """Library rescan with tags parsed in a pool of worker processes.
+
+    Directories are checked against the index in a loader thread, one at
+    a time and at a low io priority, and the files that need parsing are
+    sent to the pool in batches, SCAN_AHEAD for each worker at most. Parsed
+    tags are staged in the library on the reactor thread as they arrive.
+    The staged scan is swapped into the index in a loader thread once all
+    files are done. The checks keep to the rate of `throttle`, checks and
+    batches both pause while it says playback is stressed.
+
+    `files` counts the files done out of `filesTotal`, every file of the
+    walked directories counts, parsed or not.
+    """
+
+    def __init__(self, library, dirs, onProgress=None, workers=SCAN_WORKERS, throttle=None):
+        self.library = library
+        self.dirs = dirs
+        self.onProgress = onProgress
+        self.workers = max(1, workers)
+        self.throttle = throttle if throttle is not None else ScanThrottle()
+        self.progress = 0
+        self.files = 0
+        self.filesTotal = sum(len(filenames) for _dirpath, filenames in dirs)
+        self.applying = False
+
+        self._pool = None
+        self._stopped = Event()
+        self._pending = []
+        self._checking = False
+        self._inFlight = 0
+        self._pauseCall = None
+        self._checkCall = None
+        self._finished = Deferred()
+
+    def start(self):
+        """Deferred firing with the scan counts, see Library.endScan."""
+        self._pool = Pool(self.workers, _initWorker, (self._stopped,))
+        self._pump()
+        return self._finished
+
+    def stop(self):
+        """Stop before the swap, the Deferred of start fires with None.
+
+        Files staged so far are kept, see Library.resumeScan.
+        """
+        if self._pool is None:
+            return
+
+        for call in (self._pauseCall, self._checkCall):
+            if call is not None:
+                call.cancel()
+        self._pauseCall = self._checkCall = None
+
+        # workers skip what is left of their batches
+        self._stopped.set()
+        pool, self._pool = self._pool, None
+        pool.close()
+        reactor.callInThread(pool.join)
+        self._finished.callback(None)
+
+    def _pump(self):
+        """Hand out as much work as the throttle lets through."""
+        if self._pool is None or self._pauseCall is not None:
+            return
+
+        pause = self.throttle.pause()
+        if pause > 0:
+            self._pauseCall = reactor.callLater(pause, self._unpause)
+            return
+
+        self._submit()
+
+        if len(self.dirs) > 0 and not self._checking and self._checkCall is None:
+            wait = self.throttle.wait()
+            if wait > 0:
+                self._checkCall = reactor.callLater(wait, self._onCheckDue)
+            else:
+                self._checkDir()
+
+        self._checkFinished()
+
+    def _unpause(self):
+        self._pauseCall = None
+        self._pump()
+
+    def _onCheckDue(self):
+        self._checkCall = None
+        self._pump()
+
+    def _checkDir(self):
+        dirpath, filenames = self.dirs.pop()
+        self.throttle.consume(len(filenames))
+
+        self._checking = True
+        d = deferToLoader(self._scanFiles, dirpath, filenames)
+        d.addCallback(self._onChecked, filenames)
+        d.addErrback(self._onError)
+
+    def _scanFiles(self, dirpath, filenames):
+        # runs in a loader thread
+        with lowIoPriority():
+            return self.library.scanFiles(dirpath, filenames)
+
+    def _onChecked(self, pending, filenames):
+        self._checking = False
+        if self._pool is None:
+            # stopped
+            return
+
+        self._pending.extend(pending)
+        self.files = self.files + len(filenames) - len(pending)
+        self._reportProgress()
+        self._pump()
+
+    def _submit(self):
+        while len(self._pending) > 0 and self._inFlight < self.workers * SCAN_AHEAD:
+            if len(self._pending) < SCAN_BATCH and (len(self.dirs) > 0 or self._checking):
+                # more files to come for a full batch
+                return
+
+            batch, self._pending = self._pending[:SCAN_BATCH], self._pending[SCAN_BATCH:]
+            self._inFlight = self._inFlight + 1
+
+            kwargs = {'callback': self._onParsedInThread}
+            if _HAS_ERROR_CALLBACK:
+                # failures outside the task, like pickling, skip tryParseBatch
+                kwargs['error_callback'] = self._onErrorInThread
+            self._pool.apply_async(tryParseBatch, (batch,), **kwargs)
+
+    def _onParsedInThread(self, outcome):
+        # runs in the result handler thread of the pool
+        parsed, results = outcome
+        if parsed:
+            reactor.callFromThread(self._onParsed, results)
+        else:
+            error, trace = results
+            log.msg('Scan worker failed:\n' + trace)
+            reactor.callFromThread(self._onError, Failure(ScanError(error)))
+
+    def _onErrorInThread(self, err):
+        reactor.callFromThread(self._onError, Failure(err))
+
+    def _onParsed(self, results):
+        if self._pool is None:
+            # stopped, the results are parsed again on resume
+            return
+
+        for path_, stat_, meta in results:
+            self.library.storeParsed(path_, stat_, meta)
+
+        self._inFlight = self._inFlight - 1
+        self.files = self.files + len(results)
+        self._reportProgress()
+        self._pump()
+
+    def _onError(self, failure):
+        self._checking = False
+        if self._pool is None:
+            return
+
+        pool, self._pool = self._pool, None
+        self._stopped.set()
+        pool.close()
+        reactor.callInThread(pool.join)
+        self._finished.errback(failure)
+
+    def _reportProgress(self):
+        if self.filesTotal == 0:
+            return
+
+        progress = int(self.files * 100.0 / self.filesTotal)
+        if progress > self.progress:
+            self.progress = progress
+            if self.onProgress is not None:
+                self.onProgress(progress)
+
+    def _checkFinished(self):
+        if len(self.dirs) > 0 or self._checking or len(self._pending) > 0 or self._inFlight > 0:
+            return
+
+        pool, self._pool = self._pool, None
+        pool.close()
+        reactor.callInThread(pool.join)
+
+        self.applying = True
+        d = deferToLoader(self.library.endScan)
+        d.chainDeferred(self._finished)
@@ -0,0 +1,46 @@
+import re
+from unicodedata import normalize
+
+try:
+    from unidecode import unidecode
+except ImportError:
+    unidecode = None
+
+# ranking weight of a word by the tag it comes from
+FIELD_WEIGHTS = (('trackname', 4), ('artist', 3), ('albumartist', 3),
+                 ('album', 2), ('year', 1))
+
+_wordRe = re.compile('[a-z0-9]+')
+
+
+def fold(text):
+    """Lower case ASCII form of `text`, for indexing and queries."""
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    elif not isinstance(text, unicode):
+        text = unicode(text)
+
+    if unidecode is not None:
+        text = unidecode(text)
+    else:
+        # drops what has no ASCII base letter
+        text = normalize('NFKD', text).encode('ascii', 'ignore')
+
+    return text.lower()
+
+
+def tokenize(text):
+    return _wordRe.findall(fold(text))
+
+
+def indexWords(meta):
+    """Words of the searchable tags of `meta` with their best weight."""
+    words = {}
+    for key, weight in FIELD_WEIGHTS:
+        value = meta.get(key)
+        if value is None or value == '':
+            continue
+        for word in tokenize(value):
+            if words.get(word, 0) < weight:
+                words[word] = weight
+    return words
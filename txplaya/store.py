@@ -0,0 +1,711 @@
+from os import environ
+from threading import RLock
+from hashlib import md5
+from uuid import uuid4
+import sqlite3
+
+from txplaya.search import indexWords
+
+# changes written per transaction
+STORE_BATCH = int(environ.get('TXPLAYA_STORE_BATCH', 1000))
+# shortest search word matched as a prefix
+SEARCH_PREFIX_LENGTH = 3
+
+META_KEYS = ('type', 'artist', 'albumartist', 'album', 'trackname',
+             'tracknumber', 'discnumber', 'year', 'length')
+
+_META_COLUMNS = ', '.join(META_KEYS)
+
+# browse grouping of a track, see groupKeys
+GROUP_KEYS = ('artistKey', 'artistId', 'albumId')
+
+_BASE62 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+# track ids are the row ids in base62, longer ones are encoded paths
+TRACK_ID_LENGTH = 11
+
+# rows are updated in place, so row ids stay with their path; ids of
+# removed rows are never given out again
+_FILES = '''
+CREATE TABLE %%s (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path BLOB NOT NULL UNIQUE,
+    mtime REAL,
+    size INTEGER,
+    inode INTEGER,
+    seen INTEGER NOT NULL DEFAULT 0,
+    isTrack INTEGER NOT NULL DEFAULT 0,
+    %s,
+    %s
+)''' % (_META_COLUMNS, ', '.join(GROUP_KEYS))
+
+_INDEXES = '''
+CREATE INDEX IF NOT EXISTS files_stat ON files (inode, size);
+CREATE INDEX IF NOT EXISTS files_albumartist ON files (albumartist);
+CREATE INDEX IF NOT EXISTS files_artist ON files (artist);
+CREATE INDEX IF NOT EXISTS files_album ON files (album);
+CREATE INDEX IF NOT EXISTS files_year ON files (year);
+CREATE INDEX IF NOT EXISTS files_artistkey ON files (artistKey);
+CREATE INDEX IF NOT EXISTS files_artistid ON files (artistId);
+CREATE INDEX IF NOT EXISTS files_albumid ON files (albumId);
+'''
+
+_SCHEMA = (_FILES % 'IF NOT EXISTS files') + ''';
+
+CREATE TABLE IF NOT EXISTS words (
+    word TEXT NOT NULL,
+    fileId INTEGER NOT NULL,
+    weight INTEGER NOT NULL,
+    PRIMARY KEY (word, fileId)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS words_file ON words (fileId);
+
+CREATE TABLE IF NOT EXISTS info (
+    key TEXT PRIMARY KEY,
+    value
+);
+
+CREATE TABLE IF NOT EXISTS scanned (
+    path BLOB PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    inode INTEGER,
+    parsed INTEGER NOT NULL,
+    isTrack INTEGER NOT NULL DEFAULT 0,
+    %s
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS touched (
+    path BLOB PRIMARY KEY
+) WITHOUT ROWID;
+''' % _META_COLUMNS
+
+
+# rows and words of the parsed staged files, see applyStaged
+_APPLY_SCHEMA = '''
+CREATE TEMP TABLE IF NOT EXISTS applyFiles (
+    path BLOB PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    inode INTEGER,
+    isTrack INTEGER NOT NULL,
+    %s,
+    %s
+) WITHOUT ROWID;
+
+CREATE TEMP TABLE IF NOT EXISTS applyWords (
+    path BLOB NOT NULL,
+    word TEXT NOT NULL,
+    weight INTEGER NOT NULL
+);
+''' % (_META_COLUMNS, ', '.join(GROUP_KEYS))
+
+_APPLY_COLUMNS = ('mtime', 'size', 'inode', 'isTrack') + META_KEYS + GROUP_KEYS
+
+
+# bumped when tables need to be rebuilt, see _upgrade
+_SCHEMA_VERSION = 3
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def _meta(row):
+    return dict(zip(META_KEYS, row))
+
+
+def _values(meta):
+    """Tag and group columns of a file, `meta` None if it is no track."""
+    if meta is None:
+        return (None,) * (len(META_KEYS) + len(GROUP_KEYS))
+    return tuple(_text(meta.get(key)) for key in META_KEYS) + groupKeys(meta)
+
+
+def encodeId(number):
+    chars = []
+    while number > 0:
+        number, rest = divmod(number, 62)
+        chars.append(_BASE62[rest])
+    return ''.join(reversed(chars)) or '0'
+
+
+def decodeId(id_):
+    """Number of a base62 id, None for anything else."""
+    if not 0 < len(id_) <= TRACK_ID_LENGTH:
+        return None
+
+    number = 0
+    for char in id_:
+        digit = _BASE62.find(char)
+        if digit < 0:
+            return None
+        number = number * 62 + digit
+    return number
+
+
+def _compactId(*parts):
+    """Short base62 id hashed from `parts`, stable across rescans."""
+    digest = md5(u'\x00'.join(parts).encode('utf-8')).hexdigest()
+    return encodeId(int(digest[:16], 16))
+
+
+def groupKeys(meta):
+    """(artistKey, artistId, albumId) of a track.
+
+    Tracks are grouped under their album artist, or under their artist
+    when there is none; a leading 'the ' is left out of the sort key.
+    Albums are told apart by artist, year and lower case name.
+    """
+    artist = _text(meta.get('albumartist') or meta.get('artist') or u'')
+    artistKey = artist.lower()
+    if artistKey.startswith('the '):
+        artistKey = artistKey[4:]
+
+    album = _text(meta.get('album') or u'').lower()
+    year = unicode(meta.get('year') or u'')
+
+    return artistKey, _compactId(artistKey), _compactId(artistKey, year, album)
+
+
+class LibraryStore(object):
+    """The library index in SQLite: stats and tags of every scanned file.
+
+    Rows are read on demand. Writes are grouped into transactions of
+    STORE_BATCH changes, `commit` ends the current one. The connection is
+    shared with loader threads behind a lock. The words of the tags of
+    every track are kept in an inverted index for search.
+
+    A rescan is staged apart from the index, so readers keep seeing the
+    previous scan until applyStaged swaps it in with one transaction. The
+    staged files outlive a restart, an unfinished scan can be resumed.
+    Files written or deleted while a scan is staged are touched, their
+    newer state wins over the staged one.
+
+    Files are looked up by path. Tracks are given out by a short id, the
+    base62 form of their row id, which stays while the path is indexed
+    and is not given to another path after.
+
+    `version` names the content of the index, it changes with every
+    committed change that is bumped with bumpVersion.
+    """
+
+    def __init__(self, dbpath):
+        self._db = sqlite3.connect(dbpath, check_same_thread=False)
+        self._lock = RLock()
+        self._pending = 0
+        self._applying = False
+
+        with self._lock:
+            self._db.executescript(_SCHEMA)
+            self._upgrade()
+            self._db.executescript(_INDEXES)
+            self._db.executescript(_APPLY_SCHEMA)
+            # an unfinished scan may not have written any file yet
+            self._generation = max(
+                self._db.execute('SELECT COALESCE(MAX(seen), 0) FROM files').fetchone()[0],
+                self._getInfo('scanGeneration', 0))
+
+            # tells databases apart, versions restart with a new one
+            self._epoch = self._getInfo('epoch')
+            if self._epoch is None:
+                self._epoch = uuid4().hex[:8]
+                self._db.execute("INSERT INTO info VALUES ('epoch', ?)", (self._epoch,))
+                self._db.commit()
+            self._version = self._getInfo('version', 0)
+            self._staging = self._getInfo('scanFull') is not None
+
+    def _upgrade(self):
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+
+        if version < 1:
+            # the word index came after the files table
+            rows = self._db.execute(
+                'SELECT id, %s FROM files WHERE isTrack = 1' % _META_COLUMNS).fetchall()
+            for row in rows:
+                self._indexWords(row[0], _meta(row[1:]))
+
+        if version < 2:
+            columns = set(row[1] for row in self._db.execute('PRAGMA table_info(files)'))
+            for key in GROUP_KEYS:
+                if key not in columns:
+                    self._db.execute('ALTER TABLE files ADD COLUMN %s' % key)
+
+            rows = self._db.execute(
+                'SELECT id, %s FROM files WHERE isTrack = 1' % _META_COLUMNS).fetchall()
+            self._db.executemany(
+                'UPDATE files SET artistKey = ?, artistId = ?, albumId = ? WHERE id = ?',
+                [groupKeys(_meta(row[1:])) + (row[0],) for row in rows])
+
+        columns = set(row[1] for row in self._db.execute('PRAGMA table_info(files)'))
+        sql = self._db.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'files'").fetchone()[0]
+        if 'AUTOINCREMENT' not in sql:
+            # files were keyed by their encoded path, or had row ids that
+            # could be given out again; the row ids are kept
+            keyedByPath = 'uid' in columns
+            columns.discard('uid')
+            columns = ', '.join(sorted(columns))
+            self._db.execute('ALTER TABLE files RENAME TO files_old')
+            self._db.execute(_FILES % 'files')
+            self._db.execute('INSERT INTO files (%s) SELECT %s FROM files_old'
+                             % (columns, columns))
+            self._db.execute('DROP TABLE files_old')
+
+            if keyedByPath:
+                # track ids changed, versions of the old ones must not match
+                self._db.execute("DELETE FROM info WHERE key = 'epoch'")
+
+        self._db.execute('PRAGMA user_version = %d' % _SCHEMA_VERSION)
+        self._db.commit()
+
+    def _getInfo(self, key, default=None):
+        row = self._db.execute('SELECT value FROM info WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    @property
+    def version(self):
+        return '%s.%d' % (self._epoch, self._version)
+
+    def bumpVersion(self):
+        """Give the content a new version, saved with the next commit."""
+        with self._lock:
+            self._version = self._version + 1
+            self._db.execute("INSERT OR REPLACE INTO info VALUES ('version', ?)",
+                             (self._version,))
+
+    def _write(self, sql, args=()):
+        cursor = self._db.execute(sql, args)
+        self._pending = self._pending + 1
+        if self._pending >= STORE_BATCH and not self._applying:
+            self.commit()
+        return cursor
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+            self._pending = 0
+
+    def isEmpty(self):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM files LIMIT 1').fetchone() is None
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM files WHERE isTrack = 1').fetchone()[0]
+
+    def get(self, path_):
+        """(stat, meta) of `path_`, meta is None for files that are not tracks."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT mtime, size, inode, isTrack, %s FROM files WHERE path = ?'
+                % _META_COLUMNS, (buffer(path_),)).fetchone()
+
+        if row is None:
+            return None, None
+        if not row[3]:
+            return row[:3], None
+        return row[:3], _meta(row[4:])
+
+    def getStat(self, path_):
+        with self._lock:
+            row = self._db.execute('SELECT mtime, size, inode FROM files WHERE path = ?',
+                                   (buffer(path_),)).fetchone()
+        return row
+
+    def hasTrack(self, path_):
+        return self.trackId(path_) is not None
+
+    def trackId(self, path_):
+        """Id of the track at `path_`, None if there is none."""
+        with self._lock:
+            row = self._db.execute('SELECT id FROM files WHERE path = ? AND isTrack = 1',
+                                   (buffer(path_),)).fetchone()
+        if row is None:
+            return None
+        return encodeId(row[0])
+
+    def trackPaths(self, trackIds):
+        """{trackId: path} of the known tracks among `trackIds`."""
+        byFileId = dict((decodeId(trackId), trackId) for trackId in trackIds)
+        byFileId.pop(None, None)
+        fileIds = byFileId.keys()
+
+        paths = {}
+        with self._lock:
+            # within the bound variables sqlite allows
+            for start in xrange(0, len(fileIds), 500):
+                chunk = fileIds[start:start + 500]
+                rows = self._db.execute(
+                    'SELECT id, path FROM files WHERE isTrack = 1 AND id IN (%s)'
+                    % ', '.join('?' * len(chunk)), chunk).fetchall()
+                paths.update((byFileId[row[0]], str(row[1])) for row in rows)
+
+        return paths
+
+    def findByStat(self, stat_):
+        """Tags of a track with the same mtime, size and inode."""
+        mtime, size, inode = stat_
+        with self._lock:
+            row = self._db.execute(
+                'SELECT %s FROM files WHERE inode = ? AND size = ? AND mtime = ? '
+                'AND isTrack = 1 LIMIT 1' % _META_COLUMNS, (inode, size, mtime)).fetchone()
+
+        if row is None:
+            return None
+        return _meta(row)
+
+    def tracks(self):
+        """(trackId, meta) of all tracks."""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT id, %s FROM files WHERE isTrack = 1' % _META_COLUMNS).fetchall()
+
+        return [(encodeId(row[0]), _meta(row[1:])) for row in rows]
+
+    def pathsUnder(self, prefix):
+        """Paths of the files starting with `prefix`, which ends with '/'."""
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        with self._lock:
+            rows = self._db.execute('SELECT path FROM files WHERE path >= ? AND path < ?',
+                                    (buffer(prefix), buffer(upper))).fetchall()
+
+        return [str(row[0]) for row in rows]
+
+    def put(self, path_, stat_, meta):
+        """Store the stat and tags of a file, `meta` None if it is no track.
+
+        Returns the track id of the file.
+        """
+        mtime, size, inode = stat_ if stat_ is not None else (None, None, None)
+        args = (mtime, size, inode, self._generation, int(meta is not None)) + _values(meta)
+
+        with self._lock:
+            self._touch(path_)
+
+            # updated in place, row ids stay stable
+            cursor = self._write(
+                'UPDATE files SET mtime = ?, size = ?, inode = ?, seen = ?, isTrack = ?, '
+                + ', '.join('%s = ?' % key for key in META_KEYS + GROUP_KEYS)
+                + ' WHERE path = ?',
+                args + (buffer(path_),))
+
+            if cursor.rowcount == 0:
+                cursor = self._write(
+                    'INSERT INTO files (path, mtime, size, inode, seen, isTrack, %s, %s) '
+                    'VALUES (%s)' % (_META_COLUMNS, ', '.join(GROUP_KEYS),
+                                     ', '.join('?' * (len(args) + 1))),
+                    (buffer(path_),) + args)
+                fileId = cursor.lastrowid
+            else:
+                fileId = self._db.execute('SELECT id FROM files WHERE path = ?',
+                                          (buffer(path_),)).fetchone()[0]
+
+            self._indexWords(fileId, meta)
+
+        return encodeId(fileId)
+
+    def _indexWords(self, fileId, meta):
+        self._db.execute('DELETE FROM words WHERE fileId = ?', (fileId,))
+        if meta is None:
+            return
+
+        self._db.executemany('INSERT INTO words (word, fileId, weight) VALUES (?, ?, ?)',
+                             [(word, fileId, weight)
+                              for word, weight in indexWords(meta).iteritems()])
+
+    def _touch(self, path_):
+        if self._staging and not self._applying:
+            self._db.execute('INSERT OR IGNORE INTO touched VALUES (?)', (buffer(path_),))
+
+    def delete(self, path_):
+        with self._lock:
+            self._touch(path_)
+            self._db.execute('DELETE FROM words WHERE fileId IN '
+                             '(SELECT id FROM files WHERE path = ?)', (buffer(path_),))
+            self._write('DELETE FROM files WHERE path = ?', (buffer(path_),))
+
+    def beginStaging(self, full=False):
+        """Start staging a rescan, an unfinished one is dropped.
+
+        Files written from now on belong to the new scan generation, so
+        changes merged while the scan runs survive applyStaged.
+        """
+        with self._lock:
+            self._generation = self._generation + 1
+            self._staging = True
+            self._db.execute('DELETE FROM scanned')
+            self._db.execute('DELETE FROM touched')
+            self._db.executemany('INSERT OR REPLACE INTO info VALUES (?, ?)',
+                                 [('scanGeneration', self._generation),
+                                  ('scanFull', int(full)),
+                                  ('scanCancelled', 0)])
+            self.commit()
+
+    def stagedScan(self):
+        """(full, cancelled) of the unfinished scan, None if there is none."""
+        with self._lock:
+            full = self._getInfo('scanFull')
+            if full is None:
+                return None
+            return bool(full), bool(self._getInfo('scanCancelled', 0))
+
+    def setStagingCancelled(self, cancelled):
+        """Mark the unfinished scan as cancelled, rather than interrupted."""
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO info VALUES ('scanCancelled', ?)",
+                             (int(cancelled),))
+            self.commit()
+
+    def stagedPaths(self):
+        with self._lock:
+            rows = self._db.execute('SELECT path FROM scanned').fetchall()
+        return set(str(row[0]) for row in rows)
+
+    def stage(self, path_, stat_, meta, parsed=True):
+        """Stage a file seen by the scan, `meta` None if it is no track.
+
+        Files staged as not `parsed` keep the tags they are indexed with.
+        """
+        mtime, size, inode = stat_
+        if meta is None:
+            values = (None,) * len(META_KEYS)
+        else:
+            values = tuple(_text(meta.get(key)) for key in META_KEYS)
+
+        args = (buffer(path_), mtime, size, inode, int(parsed), int(meta is not None)) + values
+        with self._lock:
+            self._write('INSERT OR REPLACE INTO scanned (path, mtime, size, inode, parsed, '
+                        'isTrack, %s) VALUES (%s)' % (_META_COLUMNS, ', '.join('?' * len(args))),
+                        args)
+
+    def _prepareStaged(self):
+        """Fill applyFiles and applyWords from the parsed staged files.
+
+        The rows and words are made from the tags without the lock, it is
+        only held to read and write each chunk of STORE_BATCH files.
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM applyFiles')
+            self._db.execute('DELETE FROM applyWords')
+
+        last = buffer('')
+        while True:
+            with self._lock:
+                rows = self._db.execute('SELECT path, mtime, size, inode, isTrack, %s '
+                                        'FROM scanned WHERE parsed = 1 AND path > ? '
+                                        'ORDER BY path LIMIT ?' % _META_COLUMNS,
+                                        (last, STORE_BATCH)).fetchall()
+            if len(rows) == 0:
+                return
+            last = rows[-1][0]
+
+            files, words = [], []
+            for row in rows:
+                meta = _meta(row[5:]) if row[4] else None
+                files.append(tuple(row[:5]) + _values(meta))
+                if meta is not None:
+                    words.extend((row[0], word, weight)
+                                 for word, weight in indexWords(meta).iteritems())
+
+            with self._lock:
+                self._db.executemany('INSERT INTO applyFiles (path, %s) VALUES (%s)'
+                                     % (', '.join(_APPLY_COLUMNS),
+                                        ', '.join('?' * (len(_APPLY_COLUMNS) + 1))), files)
+                self._db.executemany('INSERT INTO applyWords (path, word, weight) '
+                                     'VALUES (?, ?, ?)', words)
+
+    def applyStaged(self):
+        """Swap the staged scan into the index, in a single transaction.
+
+        Files not staged nor written since beginStaging are dropped, the
+        touched ones are kept as they were written. The staged tags are
+        turned into rows beforehand, see _prepareStaged, so the swap is a
+        few statements and readers do not wait long for the lock.
+        Returns the counts of added, updated, removed and skipped tracks.
+        """
+        counts = {'added': 0, 'updated': 0, 'removed': 0, 'skipped': 0}
+
+        self._prepareStaged()
+
+        with self._lock:
+            self.commit()
+            self._applying = True
+            try:
+                rows = self._db.execute('SELECT mtime, size, inode, ?, path FROM scanned '
+                                        'WHERE parsed = 0 AND path NOT IN '
+                                        '(SELECT path FROM touched)',
+                                        (self._generation,)).fetchall()
+                self._db.executemany('UPDATE files SET mtime = ?, size = ?, inode = ?, seen = ? '
+                                     'WHERE path = ?', rows)
+                counts['skipped'] = len(rows)
+
+                # touched while the rows were made
+                self._db.execute('DELETE FROM applyFiles WHERE path IN '
+                                 '(SELECT path FROM touched)')
+
+                for isTrack, wasTrack, count in self._db.execute(
+                        'SELECT a.isTrack, COALESCE(f.isTrack, 0), COUNT(*) FROM applyFiles a '
+                        'LEFT JOIN files f ON f.path = a.path GROUP BY 1, 2'):
+                    if isTrack:
+                        counts['updated' if wasTrack else 'added'] += count
+                    elif wasTrack:
+                        counts['removed'] += count
+
+                self._db.execute('DELETE FROM words WHERE fileId IN (SELECT id FROM files '
+                                 'WHERE path IN (SELECT path FROM applyFiles))')
+
+                # known files are written over with their row id, so it stays
+                columns = ', '.join(_APPLY_COLUMNS)
+                self._db.execute(
+                    'INSERT OR REPLACE INTO files (id, path, seen, %s) '
+                    'SELECT f.id, a.path, ?, %s FROM applyFiles a '
+                    'LEFT JOIN files f ON f.path = a.path'
+                    % (columns, ', '.join('a.' + column for column in _APPLY_COLUMNS)),
+                    (self._generation,))
+
+                self._db.execute('INSERT INTO words (word, fileId, weight) '
+                                 'SELECT w.word, f.id, w.weight FROM applyWords w '
+                                 'JOIN applyFiles a ON a.path = w.path '
+                                 'JOIN files f ON f.path = w.path')
+
+                counts['removed'] += self._db.execute(
+                    'SELECT COUNT(*) FROM files WHERE seen < ? AND isTrack = 1',
+                    (self._generation,)).fetchone()[0]
+                self._db.execute('DELETE FROM words WHERE fileId IN '
+                                 '(SELECT id FROM files WHERE seen < ?)', (self._generation,))
+                self._db.execute('DELETE FROM files WHERE seen < ?', (self._generation,))
+
+                if counts['added'] + counts['updated'] + counts['removed'] > 0:
+                    self.bumpVersion()
+                self._clearStaged()
+                self._db.execute('DELETE FROM applyFiles')
+                self._db.execute('DELETE FROM applyWords')
+                self.commit()
+            except Exception:
+                # the index stays as it was, the staged scan can be applied again
+                self._db.rollback()
+                self._version = self._getInfo('version', 0)
+                self._staging = True
+                raise
+            finally:
+                self._applying = False
+
+        return counts
+
+    def discardStaged(self):
+        with self._lock:
+            self._clearStaged()
+            self.commit()
+
+    def _clearStaged(self):
+        self._staging = False
+        self._db.execute('DELETE FROM scanned')
+        self._db.execute('DELETE FROM touched')
+        self._db.execute("DELETE FROM info WHERE key IN "
+                         "('scanGeneration', 'scanFull', 'scanCancelled')")
+
+    def search(self, words, offset=0, limit=50):
+        """Tracks with a tag word matching each of `words`, best first.
+
+        The last word also matches as a prefix. Alone it has to be
+        SEARCH_PREFIX_LENGTH long, with other words the prefix is only
+        looked up among the tracks having one of them. Tracks score the
+        weights of their matching words, full word matches count extra.
+        Returns the number of matching tracks and the (trackId, meta) of the
+        requested page.
+        """
+        if len(words) == 0:
+            return 0, []
+
+        exact = sorted(set(words[:-1]))
+        prefix = words[-1]
+        if prefix in exact:
+            prefix = None
+        elif len(exact) == 0 and len(prefix) < SEARCH_PREFIX_LENGTH:
+            exact, prefix = [prefix], None
+
+        parts, args = [], []
+        for word in exact:
+            parts.append('SELECT fileId, weight + 2 AS score FROM words WHERE word = ?')
+            args.append(word)
+
+        if prefix is not None:
+            # words are [a-z0-9], '{' sorts after all of them
+            part = ('SELECT fileId, MAX(weight + 2 * (word = ?)) AS score '
+                    'FROM words WHERE word >= ? AND word < ?')
+            args.extend((prefix, prefix, prefix + '{'))
+            if len(exact) > 0:
+                # the longest word is likely the rarest
+                part = part + ' AND fileId IN (SELECT fileId FROM words WHERE word = ?)'
+                args.append(max(exact, key=len))
+            parts.append(part + ' GROUP BY fileId')
+
+        termCount = len(parts)
+        matches = ('SELECT fileId, SUM(score) AS score FROM (%s) GROUP BY fileId '
+                   'HAVING COUNT(*) = %d' % (' UNION ALL '.join(parts), termCount))
+
+        with self._lock:
+            total = self._db.execute('SELECT COUNT(*) FROM (%s)' % matches, args).fetchone()[0]
+            rows = self._db.execute(
+                'SELECT files.id, %s FROM (%s) AS matches '
+                'JOIN files ON files.id = matches.fileId '
+                'ORDER BY matches.score DESC, albumartist, year, album, discnumber, '
+                'tracknumber LIMIT ? OFFSET ?' % (
+                    ', '.join('files.' + key for key in META_KEYS), matches),
+                args + [limit, offset]).fetchall()
+
+        return total, [(encodeId(row[0]), _meta(row[1:])) for row in rows]
+
+    def artists(self, offset=0, limit=50):
+        """Page of the artists by sort key, as (artistId, name, trackCount).
+
+        Returns the number of artists along with the page.
+        """
+        with self._lock:
+            total = self._db.execute('SELECT COUNT(DISTINCT artistKey) FROM files '
+                                     'WHERE isTrack = 1').fetchone()[0]
+            rows = self._db.execute(
+                "SELECT MIN(artistId), MIN(COALESCE(NULLIF(albumartist, ''), artist, '')), "
+                'COUNT(*) FROM files WHERE isTrack = 1 GROUP BY artistKey '
+                'ORDER BY artistKey LIMIT ? OFFSET ?', (limit, offset)).fetchall()
+
+        return total, rows
+
+    def albums(self, artistId, offset=0, limit=50):
+        """Page of the albums of an artist by year and name.
+
+        Returns the number of albums and (albumId, name, year, trackCount).
+        """
+        with self._lock:
+            total = self._db.execute('SELECT COUNT(DISTINCT albumId) FROM files '
+                                     'WHERE artistId = ? AND isTrack = 1',
+                                     (artistId,)).fetchone()[0]
+            rows = self._db.execute(
+                "SELECT albumId, MIN(COALESCE(album, '')), MIN(year), COUNT(*) FROM files "
+                'WHERE artistId = ? AND isTrack = 1 GROUP BY albumId '
+                'ORDER BY MIN(year), MIN(album) LIMIT ? OFFSET ?',
+                (artistId, limit, offset)).fetchall()
+
+        return total, rows
+
+    def albumTracks(self, albumId, offset=0, limit=50):
+        """Page of the tracks of an album in disc and track order.
+
+        Returns the number of tracks and their (trackId, meta).
+        """
+        with self._lock:
+            total = self._db.execute('SELECT COUNT(*) FROM files '
+                                     'WHERE albumId = ? AND isTrack = 1',
+                                     (albumId,)).fetchone()[0]
+            rows = self._db.execute(
+                'SELECT id, %s FROM files WHERE albumId = ? AND isTrack = 1 '
+                'ORDER BY discnumber, tracknumber, trackname LIMIT ? OFFSET ?' % _META_COLUMNS,
+                (albumId, limit, offset)).fetchall()
+
+        return total, [(encodeId(row[0]), _meta(row[1:])) for row in rows]
@@ -1,9 +1,19 @@
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
 from math import ceil
+import os
+from os import fstat, environ
+from threading import Lock
 
 from mutagen.id3 import ID3
 from mutagen.mp3 import MP3
 from mutagen.mp4 import MP4
-from werkzeug.utils import cached_property
+
+from txplaya.iohints import FADV_WILLNEED, fadvise
+from txplaya.mpeg import FrameIndex, id3v2Size
+
+# parsed files kept by (path, mtime, size)
+PARSE_CACHE_SIZE = int(environ.get('TXPLAYA_PARSE_CACHE_SIZE', 4096))
 
 
 def _parseId3(id3):
@@ -62,28 +72,274 @@ def _parseMp4(mp4):
     return meta
 
 
-class Track(object):
+class FileInfo(object):
+    """Everything read from an audio file header in a single parse.
 
-    def __init__(self, path):
-        self._path = path
-        self._meta = self._parseTags()
+    `meta` holds the tags (None when the file has none), `audioStart` and
+    `audioEnd` delimit the audio stream inside the file.
+    """
+
+    __slots__ = ('meta', 'length', 'bitrate', 'audioStart', 'audioEnd')
 
-    def _parseTags(self):
-        _meta = {'artist': '', 'length': self.length}
+    def __init__(self, meta=None, length=0, bitrate=0, audioStart=0, audioEnd=0):
+        self.meta = meta
+        self.length = length
+        self.bitrate = bitrate
+        self.audioStart = audioStart
+        self.audioEnd = audioEnd
 
+
+def _parseMpegFile(f, header, size):
+    id3 = None
+    try:
+        mp3 = MP3(f)
+    except Exception:
+        # not an MPEG stream, the tags may still be readable
+        length, bitrate = 0, 0
         try:
-            id3 = ID3(self._path)
+            f.seek(0)
+            id3 = ID3(f)
         except Exception:
-            try:
-                mp4 = MP4(self._path)
-            except Exception:
-                return None
+            pass
+    else:
+        length, bitrate = mp3.info.length, mp3.info.bitrate
+        id3 = mp3.tags
+
+    audioEnd = size
+    if size >= 128:
+        f.seek(size - 128)
+        if f.read(3) == 'TAG':
+            audioEnd = size - 128
+
+    info = FileInfo(length=length, bitrate=bitrate,
+                    audioStart=id3v2Size(header), audioEnd=audioEnd)
+    if id3 is not None:
+        info.meta = {'artist': '', 'length': length}
+        info.meta.update(_parseId3(id3))
+    return info
+
+
+def _parseMp4File(f, size):
+    try:
+        mp4 = MP4(f)
+    except Exception:
+        return FileInfo(audioEnd=size)
+
+    length = mp4.info.length
+    info = FileInfo(length=length, bitrate=mp4.info.bitrate, audioEnd=size)
+    if mp4.tags is not None:
+        info.meta = {'artist': '', 'length': length}
+        info.meta.update(_parseMp4(mp4.tags))
+    return info
+
+
+_parseCache = OrderedDict()
+_parseCacheLock = Lock()
+
+
+def parseFile(path):
+    """Sniff the format of `path` and parse it with one open.
+
+    Results are cached by path, mtime and size, so unchanged files are
+    not parsed again.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return FileInfo()
+
+    key = (path, st.st_mtime, st.st_size)
+    with _parseCacheLock:
+        info = _parseCache.pop(key, None)
+        if info is not None:
+            _parseCache[key] = info
+            return info
+
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(12)
+            f.seek(0)
+            if header[4:8] == 'ftyp':
+                info = _parseMp4File(f, st.st_size)
             else:
-                _meta.update(_parseMp4(mp4.tags))
+                info = _parseMpegFile(f, header, st.st_size)
+    except IOError:
+        return FileInfo()
+
+    with _parseCacheLock:
+        _parseCache[key] = info
+        while len(_parseCache) > PARSE_CACHE_SIZE:
+            _parseCache.popitem(last=False)
+
+    return info
+
+
+READAHEAD_TIME = 5.0
+
+
+class ChunkSource(object):
+    """Iterates over a byte range of a file as chunks without loading it whole.
+
+    Subclasses decide the size and duration of every chunk in `_nextChunk`.
+    Only about READAHEAD_TIME seconds past the playhead are kept in memory,
+    the rest is read from disk as chunks are handed out. `elapsed` is the
+    playback time of the chunks handed out so far.
+    """
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, path, start, end, length):
+        self._file = open(path, 'rb')
+        if end is None:
+            end = fstat(self._file.fileno()).st_size
+        self._file.seek(start)
+
+        self.size = end - start
+        self.length = length
+        self.position = 0
+        self.elapsed = 0.0
+
+        if length > 0:
+            self._readAheadSize = int(ceil(self.size * READAHEAD_TIME / length))
+        else:
+            self._readAheadSize = self.size
+
+        self._buf = ''
+        self._bufOffset = 0
+
+    def __iter__(self):
+        return self
+
+    @abstractmethod
+    def _nextChunk(self):
+        """(size, duration) of the next chunk, None past the last one."""
+
+    def _fill(self, size):
+        available = len(self._buf) - self._bufOffset
+        if available >= size or self._file is None:
+            return
+
+        # keep only the unconsumed tail, it is never longer than one chunk
+        tail = self._buf[self._bufOffset:]
+        readSize = max(self._readAheadSize, size - len(tail))
+        readSize = min(readSize, self.size - self.position - len(tail))
+        self._buf = tail + self._file.read(readSize)
+        self._bufOffset = 0
+
+    def prefetch(self):
+        """Read the first window ahead and hint the kernel about the rest."""
+        if self._file is not None:
+            fadvise(self._file.fileno(), FADV_WILLNEED)
+
+        self._fill(self._readAheadSize)
+
+    def next(self):
+        chunk = self._nextChunk()
+        if chunk is None:
+            self.close()
+            raise StopIteration
+
+        size, duration = chunk
+        size = min(size, self.size - self.position)
+        self._fill(size)
+
+        buf = self._buf[self._bufOffset:self._bufOffset + size]
+        if buf == '':
+            self.close()
+            raise StopIteration
+
+        self._bufOffset = self._bufOffset + len(buf)
+        self.position = self.position + len(buf)
+        self.elapsed = self.elapsed + duration
+
+        return buf
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._buf = ''
+        self._bufOffset = 0
+
+
+class BitrateChunkSource(ChunkSource):
+    """Equal byte slices of the whole file, assuming a constant bitrate."""
+
+    def __init__(self, path, length, prebufTime, iterTime):
+        ChunkSource.__init__(self, path, 0, None, length)
+
+        self._bytesPerSec = self.size * 1.0 / length
+        self._prebufTime = prebufTime
+        self._iterTime = iterTime
+
+    def _nextChunk(self):
+        if self.position >= self.size:
+            return None
+
+        if self.position == 0:
+            duration = self._prebufTime
         else:
-            _meta.update(_parseId3(id3))
+            duration = self._iterTime
+
+        size = int(ceil(self._bytesPerSec * duration))
+        return size, min(duration, self.length - self.elapsed)
+
+
+class FrameChunkSource(ChunkSource):
+    """Chunks aligned to MPEG frame boundaries.
+
+    Chunk ends follow a fixed schedule of prebufTime + k * iterTime seconds,
+    so chunk durations stay within one frame of iterTime and never drift.
+    """
+
+    def __init__(self, path, frameIndex, prebufTime, iterTime):
+        ChunkSource.__init__(self, path, frameIndex.offsets[0], frameIndex.end,
+                             frameIndex.length)
 
-        return _meta
+        self._index = frameIndex
+        self._frame = 0
+        self._target = prebufTime
+        self._iterTime = iterTime
+
+    def _nextChunk(self):
+        offsets, durations = self._index.offsets, self._index.durations
+        frameCount = len(offsets)
+
+        first = self._frame
+        if first >= frameCount:
+            return None
+
+        frame, elapsed = first, self.elapsed
+        while frame < frameCount and (frame == first or elapsed < self._target):
+            elapsed = elapsed + durations[frame]
+            frame = frame + 1
+
+        self._frame = frame
+        self._target = self._target + self._iterTime
+
+        size = self._index.frameEnd(frame - 1) - offsets[first]
+        return size, elapsed - self.elapsed
+
+
+class Track(object):
+
+    __slots__ = ('_path', '_info', '_meta', '_frameIndex')
+
+    def __init__(self, path):
+        self._path = path
+        self._info = parseFile(path)
+        self._meta = self._info.meta
+        self._frameIndex = None
+
+    @classmethod
+    def fromMeta(cls, path, meta):
+        """Track built from already known tags, without touching the file."""
+        track = cls.__new__(cls)
+        track._path = path
+        track._info = FileInfo(meta=meta, length=meta['length'])
+        track._meta = meta
+        track._frameIndex = None
+        return track
 
     @property
     def path(self):
@@ -96,50 +352,38 @@ class Track(object):
         return data
 
     def dataChunks(self, iterTime):
-        rawData = self.data
-
         type_ = self.meta.get('type')
         if type_ == 'mp3':
-            prebufTime = 0.3
-        elif type_ == 'm4a':
-            prebufTime = 70.0
-        else:
-            return []
-
-        prebufSize = len(rawData) * prebufTime / self.length
-        prebufSize = int(ceil(prebufSize))
-        prebufChunk, rawData = rawData[:prebufSize], rawData[prebufSize:]
-
-        remainingLenght = self.length - prebufTime
+            frameIndex = self.frameIndex
+            if len(frameIndex) > 0:
+                return FrameChunkSource(self._path, frameIndex, 0.3, iterTime)
+            return BitrateChunkSource(self._path, self.length, 0.3, iterTime)
 
-        numChunks = remainingLenght * 1.0 / iterTime
-        chunkSize = int(ceil(len(rawData) / numChunks))
-
-        chunks = [prebufChunk]
-
-        while len(rawData) > 0:
-            chunk, rawData = rawData[:chunkSize], rawData[chunkSize:]
-            chunks.append(chunk)
+        elif type_ == 'm4a':
+            return BitrateChunkSource(self._path, self.length, 70.0, iterTime)
 
-        del rawData
+        return None
 
-        return chunks
+    @property
+    def frameIndex(self):
+        if self._frameIndex is None:
+            with open(self._path, 'rb') as f:
+                self._frameIndex = FrameIndex.fromFile(f)
+        return self._frameIndex
 
-    @cached_property
+    @property
     def length(self):
-        try:
-            return MP3(self._path).info.length
-        except Exception:
-            try:
-                return MP4(self._path).info.length
-            except Exception:
-                return 0
+        return self._info.length
+
+    @property
+    def bitrate(self):
+        return self._info.bitrate
 
     @property
     def meta(self):
         return self._meta
 
-    @cached_property
+    @property
     def has_tags(self):
         if self.meta is None:
             return False
@@ -151,26 +395,26 @@ class Track(object):
     def trackName(self):
         return self._meta['trackname']
 
-    @cached_property
+    @property
     def artist(self):
         return self._meta['artist']
 
-    @cached_property
+    @property
     def album(self):
         return self._meta['album']
 
-    @cached_property
+    @property
     def albumArtist(self):
         return self._meta['albumartist']
 
-    @cached_property
+    @property
     def discNumber(self):
         return self._meta['discnumber']
 
-    @cached_property
+    @property
     def trackNumber(self):
         return self._meta['tracknumber']
 
-    @cached_property
+    @property
     def year(self):
         return self._meta['year']
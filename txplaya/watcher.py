@@ -0,0 +1,123 @@
+from os import environ, walk, pathsep
+from os.path import abspath, isdir
+from os.path import join as path_join
+
+from twisted.internet import reactor
+from twisted.python import log
+from twisted.python.filepath import FilePath
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    # inotify is linux only
+    inotify = None
+
+from txplaya.library import PATH
+from txplaya.loader import deferToLoader
+
+# watch the library roots for changes, off unless set to 1
+WATCH_LIBRARY = environ.get('TXPLAYA_WATCH_LIBRARY', '0') == '1'
+# seconds without events before changed files are parsed
+WATCH_DELAY = float(environ.get('TXPLAYA_WATCH_DELAY', 2.0))
+
+
+def _expand(files, dirs, library):
+    """Files to check for the changed `files` and directories `dirs`."""
+    paths = set(files)
+    for dirpath in dirs:
+        # directories moved out report no events for their files
+        paths.update(library.knownUnder(dirpath))
+        if isdir(dirpath):
+            for subdir, _, filenames in walk(dirpath):
+                paths.update(path_join(subdir, filename) for filename in filenames)
+
+    return library.readChanges(sorted(paths))
+
+
+class LibraryWatcher(object):
+    """Keeps the library in sync with the filesystem through inotify.
+
+    Events are collected until none arrived for WATCH_DELAY seconds, then
+    the changed files are parsed in a loader thread and merged into the
+    library. `onChanged` is called with the resulting delta.
+    """
+
+    mask = 0
+    if inotify is not None:
+        mask = (inotify.IN_CLOSE_WRITE | inotify.IN_CREATE | inotify.IN_DELETE
+                | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO)
+
+    def __init__(self, library, onChanged):
+        self.library = library
+        self.onChanged = onChanged
+
+        self._notifier = None
+        self._files = set()
+        self._dirs = set()
+        self._flushCall = None
+        self._reading = False
+
+    def start(self):
+        if inotify is None:
+            log.msg('inotify is not available, library is not watched')
+            return False
+
+        self._notifier = inotify.INotify()
+        self._notifier.startReading()
+
+        for root in map(abspath, PATH.split(pathsep)):
+            self._notifier.watch(FilePath(root), mask=self.mask, autoAdd=True,
+                                 recursive=True, callbacks=[self._onEvent])
+
+        return True
+
+    def stop(self):
+        if self._flushCall is not None and self._flushCall.active():
+            self._flushCall.cancel()
+
+        if self._notifier is not None:
+            self._notifier.loseConnection()
+            self._notifier = None
+
+    def _onEvent(self, _watch, filepath, mask):
+        if mask & inotify.IN_ISDIR:
+            self._dirs.add(filepath.path)
+        else:
+            self._files.add(filepath.path)
+
+        if self._flushCall is not None and self._flushCall.active():
+            self._flushCall.reset(WATCH_DELAY)
+        else:
+            self._flushCall = reactor.callLater(WATCH_DELAY, self._flush)
+
+    def _flush(self):
+        self._flushCall = None
+        if self._reading:
+            # picked up when the running read is done
+            return
+
+        files, self._files = self._files, set()
+        dirs, self._dirs = self._dirs, set()
+
+        self._reading = True
+        d = deferToLoader(_expand, files, dirs, self.library)
+        d.addCallback(self._onRead)
+        d.addErrback(log.err)
+        d.addBoth(self._onReadDone)
+
+    def _onRead(self, results):
+        # merged in a loader thread too, a rescan may hold the library index
+        d = deferToLoader(self.library.applyChanges, results)
+        d.addCallback(self._onApplied)
+        return d
+
+    def _onApplied(self, delta):
+        if not (delta['added'] or delta['updated'] or delta['removed']):
+            return
+
+        self.onChanged(delta)
+
+    def _onReadDone(self, _):
+        self._reading = False
+        if (self._files or self._dirs) and self._flushCall is None:
+            self._flushCall = reactor.callLater(WATCH_DELAY, self._flush)
@@ -107,9 +107,12 @@ class MainWindow(Ui_MainWindow, QMainWindow):
         saveShortcut.activated.connect(self.onPlaylistSave)
 
         self.infoStreamStart()
-        QTimer.singleShot(200, self.fetchLibrary)
+        QTimer.singleShot(200, self.library.reload)
 
     def infoStreamStart(self):
+        # the server may have restarted, take whatever playlist it sends first
+        self.playlistModel.resetVersion()
+
         self.infoStream = QInfoStream()
         self.infoStream.trackStarted.connect(self.playback.trackStarted)
         self.infoStream.trackStarted.connect(self.playlistModel.trackActivated)
@@ -117,13 +120,13 @@ class MainWindow(Ui_MainWindow, QMainWindow):
         self.infoStream.playbackFinished.connect(self.playlistModel.trackActivated)
         self.infoStream.playbackPaused.connect(self.playback.paused)
         self.infoStream.playlistChanged.connect(self.onPlaylistChanged)
+        self.infoStream.playlistDelta.connect(self.onPlaylistDelta)
         self.infoStream.disconnected.connect(self.reconnectDialog)
         self.infoStream.timerUpdated.connect(self.playback.timerUpdated)
         self.infoStream.playlistRegistryUpdated.connect(self.playlistRegistryUpdated)
-
-    def fetchLibrary(self):
-        from txplayagui.client import getLibrary
-        onHttpResponse(getLibrary(), self.onLibraryLoaded)
+        self.infoStream.libraryChanged.connect(self.library.libraryModel.applyDelta)
+        self.infoStream.scanProgress.connect(self.library.scanEvent)
+        self.infoStream.scanFinished.connect(self.library.scanEnded)
 
     def playlistDragEnterEvent(self, event):
         self._playlistDragDropHandle(event, isDropped=False)
@@ -132,7 +135,7 @@ class MainWindow(Ui_MainWindow, QMainWindow):
         self._playlistDragDropHandle(event, isDropped=True)
 
     def _playlistDragDropHandle(self, event, isDropped):
-        from txplayagui.client import moveTrack, libraryInsert
+        from txplayagui.client import moveTrack, playlistBatch
 
         mimeData = event.mimeData()
 
@@ -145,21 +148,18 @@ class MainWindow(Ui_MainWindow, QMainWindow):
             rowTarget = self.playlistModel.rowCount()
 
         if mimeData.hasUrls():
-            urls = mimeData.urls()
-            if len(urls) > 0:
-                url = urls[0]
-                if url.isLocalFile():
-                    if not isDropped:
-                        event.acceptProposedAction()
-                        return
-
-                    # file dropped
-                    filepath = url.toLocalFile()
-
-                    from txplayagui.client import insert
-                    _ = insert(filepath, rowTarget)
+            filepaths = [unicode(url.toLocalFile()) for url in mimeData.urls()
+                         if url.isLocalFile()]
+            if len(filepaths) > 0:
+                if not isDropped:
+                    event.acceptProposedAction()
                     return
 
+                # files dropped, added in one batch
+                _ = playlistBatch([{'op': 'insert', 'position': rowTarget,
+                                    'filepaths': filepaths}])
+                return
+
         # no urls or not local file
         if not mimeData.hasText():
             return
@@ -186,17 +186,8 @@ class MainWindow(Ui_MainWindow, QMainWindow):
 
         elif source == 'library':
             hashes = [item['hash'] for item in data['items']]
-            libraryInsert(hashes, position=rowTarget)
-
-    def onLibraryLoaded(self, response):
-        try:
-            data = json.loads(response.data)
-            self.library.rescanFinished(data['library'])
-
-            if 'msg' in data:
-                print data['msg']
-        except Exception, err:
-            print 'Library load error:', repr(err)
+            _ = playlistBatch([{'op': 'insert', 'position': rowTarget,
+                                'trackIds': hashes}])
 
     def _play(self, index):
         from txplayagui.client import play
@@ -292,9 +283,36 @@ class MainWindow(Ui_MainWindow, QMainWindow):
 
     @pyqtSlot(object)
     def onPlaylistChanged(self, data):
+        version, epoch = data.get('version'), data.get('epoch')
+        if self.playlistModel.isStale(version, epoch):
+            # a delta newer than this snapshot was already applied
+            return
+
+        self.playlistModel.updateAll(data['playlist'], version, epoch)
+        self._onPlaylistUpdated(data)
+
+    def onPlaylistDelta(self, data):
+        if not self.playlistModel.applyDelta(data['base'], data['version'], data['ops'],
+                                             data.get('epoch')):
+            # missed a change, fetch the whole playlist
+            from txplayagui.client import getPlaylist
+            onHttpResponse(getPlaylist(), self.onPlaylistFetched)
+            return
+
+        self._onPlaylistUpdated(data)
+
+    def onPlaylistFetched(self, response):
+        try:
+            data = json.loads(response.data)
+        except ValueError, err:
+            print 'Playlist load error:', repr(err)
+            return
+
+        self.onPlaylistChanged(data)
+
+    def _onPlaylistUpdated(self, data):
         self.playlistModel.hasUndo = data['hasUndo']
         self.playlistModel.hasRedo = data['hasRedo']
-        self.playlistModel.updateAll(data['playlist'])
         self.playlistModel.setPlayingPosition(data['position'])
         self.playlistLengthLabel.setText(self.playlistModel.fullLength())
 
@@ -305,8 +323,8 @@ class MainWindow(Ui_MainWindow, QMainWindow):
 
     @pyqtSlot(list)
     def onLibraryItemActivated(self, hashes):
-        from txplayagui.client import libraryInsert
-        _ = libraryInsert(hashes)
+        from txplayagui.client import playlistBatch
+        _ = playlistBatch([{'op': 'insert', 'trackIds': hashes}])
 
     @pyqtSlot(list)
     def playlistRegistryUpdated(self, list_):
@@ -0,0 +1,59 @@
+from hashlib import md5
+import json
+from os import listdir, makedirs, remove, rename
+from os.path import join as path_join, isdir
+
+from PyQt5.QtCore import QStandardPaths
+
+
+def cacheDir():
+    location = QStandardPaths.writableLocation(QStandardPaths.GenericCacheLocation)
+    return path_join(location, 'txplaya')
+
+
+class ResponseCache(object):
+    """Response bodies of a server kept on disk with their ETag, by key.
+
+    Errors reading or writing the cache leave it empty, the responses are
+    then fetched as if never seen.
+    """
+
+    def __init__(self, server, path_=None):
+        if path_ is None:
+            path_ = cacheDir()
+        self._path = path_join(path_, md5(server).hexdigest()[:16])
+
+    def _filepath(self, key):
+        return path_join(self._path, md5(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        """(etag, data) of the JSON body saved for `key`, Nones if none is."""
+        try:
+            with open(self._filepath(key), 'rb') as f:
+                etag, body = f.read().split('\n', 1)
+            return etag, json.loads(body)
+        except (IOError, ValueError):
+            return None, None
+
+    def put(self, key, etag, body):
+        if etag is None:
+            return
+
+        filepath = self._filepath(key)
+        try:
+            if not isdir(self._path):
+                makedirs(self._path)
+
+            # readers never see a partial file
+            with open(filepath + '.tmp', 'wb') as f:
+                f.write(etag + '\n' + body)
+            rename(filepath + '.tmp', filepath)
+        except (IOError, OSError), err:
+            print 'Cache write error:', repr(err)
+
+    def clear(self):
+        try:
+            for filename in listdir(self._path):
+                remove(path_join(self._path, filename))
+        except OSError:
+            pass
@@ -1,3 +1,6 @@
+import json
+import zlib
+
 from PyQt5.QtCore import pyqtSignal, QObject, QUrl, pyqtSlot
 from PyQt5.QtNetwork import QNetworkAccessManager, QNetworkRequest, QNetworkReply
 
@@ -22,6 +25,9 @@ class QBaseRequest(QObject):
         self.qUrl = QUrl(url)
 
         self.request = QNetworkRequest(self.qUrl)
+        # decoded here, Qt only decodes when it sets the header itself
+        self.request.setRawHeader('Accept-Encoding', 'gzip, deflate')
+        self._decoder = None
 
     @property
     def manager(self):
@@ -34,6 +40,18 @@ class QBaseRequest(QObject):
         self.response.close()
         self.response.deleteLater()
 
+    @pyqtSlot()
+    def _onMetaData(self):
+        coding = self.response.rawHeader('Content-Encoding').data().lower()
+        if coding in ('gzip', 'deflate'):
+            # zlib tells the two apart by their header
+            self._decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+    def _decode(self, data):
+        if self._decoder is None:
+            return data
+        return self._decoder.decompress(data)
+
     @pyqtSlot(QNetworkReply.NetworkError)
     def _onError(self, code):
         if code != QNetworkReply.NoError:
@@ -44,13 +62,22 @@ class QRequest(QBaseRequest):
 
     def get(self):
         self.response = self.manager.get(self.request)
+        self.response.metaDataChanged.connect(self._onMetaData)
+        self.response.finished.connect(self._onFinished)
+        self.response.error.connect(self._onError)
+
+    def post(self, data, contentType='application/json'):
+        self.request.setHeader(QNetworkRequest.ContentTypeHeader, contentType)
+        self.response = self.manager.post(self.request, data)
+        self.response.metaDataChanged.connect(self._onMetaData)
         self.response.finished.connect(self._onFinished)
         self.response.error.connect(self._onError)
 
     @pyqtSlot()
     def _onFinished(self):
-        self.data = self.response.readAll().data()
+        self.data = self._decode(self.response.readAll().data())
         self.statusCode = self.response.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        self.etag = self.response.rawHeader('ETag').data() or None
 
         self.finished.emit(self)
         self.response.deleteLater()
@@ -67,11 +94,12 @@ class QStreamRequest(QBaseRequest):
     def get(self):
         self.response = self.manager.get(self.request)
         self.response.readyRead.connect(self._onReadyRead)
+        self.response.metaDataChanged.connect(self._onMetaData)
         self.response.finished.connect(self._onFinished)
         self.response.error.connect(self._onError)
 
     def _onReadyRead(self):
-        tmp = self.response.readAll().data()
+        tmp = self._decode(self.response.readAll().data())
         self._buf = self._buf + tmp
         while '\n' in self._buf:
             line, self._buf = self._buf.split('\n', 1)
@@ -87,11 +115,19 @@ class QStreamRequest(QBaseRequest):
         self.response.deleteLater()
 
 
-def _requestGet(url):
-    rq = QRequest(url)
+def _requestGet(url, params=None, etag=None):
+    rq = QRequest(url, params)
+    if etag is not None:
+        # answered with 304 and no body while it is current
+        rq.request.setRawHeader('If-None-Match', etag)
     rq.get()
     return rq
 
+def _requestPostJson(url, data):
+    rq = QRequest(url)
+    rq.post(json.dumps(data))
+    return rq
+
 def getPlaylist():
     url = baseUrl() + '/playlist'
     return _requestGet(url)
@@ -141,19 +177,32 @@ def getLibrary():
     url = baseUrl() + '/library'
     return _requestGet(url)
 
+def getArtists(offset=0, limit=50, etag=None):
+    url = baseUrl() + '/library/artists'
+    return _requestGet(url, {'offset': offset, 'limit': limit}, etag)
+
+def getArtistAlbums(artistId, offset=0, limit=50, etag=None):
+    url = '%s/library/artists/%s/albums' % (baseUrl(), artistId)
+    return _requestGet(url, {'offset': offset, 'limit': limit}, etag)
+
+def getAlbumTracks(albumId, offset=0, limit=50, etag=None):
+    url = '%s/library/albums/%s/tracks' % (baseUrl(), albumId)
+    return _requestGet(url, {'offset': offset, 'limit': limit}, etag)
+
+def searchLibrary(query, offset=0, limit=50):
+    url = baseUrl() + '/library/search'
+    return _requestGet(url, {'q': query, 'offset': offset, 'limit': limit})
+
 def rescanLibrary():
     url = baseUrl() + '/library/rescan'
     rq = QStreamRequest(url)
     rq.get()
     return rq
 
-def libraryInsert(hashes, position=None):
-    url = baseUrl() + '/playlist/library/insert/'
-    if position is not None:
-        url = url + str(position) + '/'
-    hashes_ = ','.join(hashes)
-    url = url + hashes_
-    return _requestGet(url)
+def playlistBatch(ops):
+    """Apply insert/remove/move `ops` to the playlist in one request."""
+    url = baseUrl() + '/playlist/batch'
+    return _requestPostJson(url, {'ops': ops})
 
 def infostream():
     url = baseUrl() + '/infostream'
@@ -9,9 +9,13 @@ class QInfoStream(QObject):
     playbackFinished = pyqtSignal()
     playbackPaused = pyqtSignal(bool)
     playlistChanged = pyqtSignal(object)
+    playlistDelta = pyqtSignal(object)
     disconnected = pyqtSignal()
     timerUpdated = pyqtSignal(int)
     playlistRegistryUpdated = pyqtSignal(object)
+    libraryChanged = pyqtSignal(object)
+    scanProgress = pyqtSignal(object)
+    scanFinished = pyqtSignal(object)
 
     def __init__(self):
         QObject.__init__(self)
@@ -40,6 +44,9 @@ class QInfoStream(QObject):
         elif event == 'PlaylistChanged':
             self.playlistChanged.emit(data)
 
+        elif event == 'PlaylistDelta':
+            self.playlistDelta.emit(data)
+
         elif event == 'TimerUpdate':
             progress = int(data['time'])
             self.timerUpdated.emit(progress)
@@ -48,6 +55,15 @@ class QInfoStream(QObject):
             list_ = data['list']
             self.playlistRegistryUpdated.emit(list_)
 
+        elif event == 'LibraryChanged':
+            self.libraryChanged.emit(data)
+
+        elif event == 'ScanProgress':
+            self.scanProgress.emit(data)
+
+        elif event == 'ScanFinished':
+            self.scanFinished.emit(data)
+
         else:
             print 'Infostream: %s event not implemented' % event
 
@@ -1,20 +1,46 @@
+from functools import partial
 import gc
+import json
 
-from unidecode import unidecode
 from werkzeug.utils import cached_property
 
-from PyQt5.QtCore import QAbstractItemModel, QModelIndex, Qt, pyqtSignal
+from PyQt5.QtCore import QAbstractItemModel, QModelIndex, Qt
 
-from txplayagui.utilities import mimeWrapJson, SortedDict
+from txplayagui.cache import ResponseCache
+from txplayagui.utilities import mimeWrapJson, SortedDict, onHttpResponse
+
+# rows asked from the server per page while browsing
+BROWSE_PAGE_SIZE = 200
+
+
+def artistName(meta):
+    """Name of the artist a track is grouped under, as on the server."""
+    return meta['albumartist'] or meta['artist'] or ''
+
+
+def trackKey(meta):
+    track = (meta['discnumber'], meta['tracknumber'], meta['trackname'])
+
+    artist = meta['artist']
+    if artist != artistName(meta):
+        return track + (artist,)
+    return track + ('',)
 
 
 class LibraryItem(object):
 
+    id = None
+
     def __init__(self, data):
         self._children = SortedDict()
         self._data = data
         self._parent = None
 
+        # children read from the server and their count there, None
+        # until the first page arrives
+        self.fetched = 0
+        self.total = None
+
     def row(self):
         return self.parentItem()._children.index(self._data)
 
@@ -25,6 +51,13 @@ class LibraryItem(object):
     def parentItem(self):
         return self._parent
 
+    def canFetchMore(self):
+        return self.total is None or self.fetched < self.total
+
+    def setComplete(self):
+        """Mark the children as all known, nothing is fetched for them."""
+        self.fetched = self.total = len(self._children)
+
     def clear(self):
         self._parent = None
         while self._children:
@@ -36,8 +69,8 @@ class ArtistItem(LibraryItem):
 
     @classmethod
     def getKey(cls, data):
-        key = data
-        if key.lower().startswith('the '):
+        key = data.lower()
+        if key.startswith('the '):
             key = key[4:]
         return key
 
@@ -61,7 +94,7 @@ class ArtistItem(LibraryItem):
         LibraryItem.clear(self)
         self.model = None
 
-    def getAlbum(self, album):
+    def findAlbum(self, album):
         year, albumName = album
         albumNameLower = albumName.lower()
 
@@ -70,19 +103,7 @@ class ArtistItem(LibraryItem):
             if _year == year and albumNameLower == _albumName.lower():
                 return albumItem
 
-        # not found
-        albumItem = AlbumItem(album)
-        albumItem._parent = self
-        self._children[album] = albumItem
-        return albumItem
-
-    def removeAlbum(self, album):
-        albumItem = self._children[album]
-        albumItem.clear()
-        del self._children[album]
-
-        if len(self._children) == 0:
-            self.model.removeArtist(self._data)
+        return None
 
 
 class AlbumItem(LibraryItem):
@@ -116,14 +137,6 @@ class AlbumItem(LibraryItem):
 
         return self._discCount
 
-    def removeTrack(self, track):
-        trackItem = self._children[track]
-        trackItem.clear()
-        del self._children[track]
-
-        if len(self._children) == 0:
-            albumkey = self._data
-            self.artistItem().removeAlbum(albumkey)
 
 class TrackItem(LibraryItem):
 
@@ -140,9 +153,7 @@ class TrackItem(LibraryItem):
         else:
             display = trackname
 
-        albumArtist = self.albumItem().mimeDataDict['albumartist']
-
-        if artist != '' and artist != albumArtist:
+        if artist != '':
             display = display + ' - %s' % artist
 
         return display
@@ -160,29 +171,45 @@ class TrackItem(LibraryItem):
                     'hash': self.hash})
         return res
 
-    @cached_property
-    def _queryText(self):
-        meta = self.mimeDataDict
-        queryText = ' '.join([meta['artist'], meta['album'], meta['albumartist'],
-                              meta['trackname'], str(meta['year'])])
-        queryText = unidecode(queryText).lower()
-        return queryText
-
-    def match(self, query):
-        return query in self._queryText
+    def canFetchMore(self):
+        return False
 
     def albumItem(self):
         return self._parent
 
 
 class LibraryModel(QAbstractItemModel):
+    """Library tree of artists, their albums and the album tracks.
+
+    Browsing, the tree is filled page by page from the server as the view
+    asks for rows: artists at the top level, the albums of an artist and
+    the tracks of an album when they are expanded. loadData instead shows
+    a given set of tracks, like search results, all at once.
 
-    toggleRow = pyqtSignal(int, QModelIndex, bool)
+    Browsed pages are cached on disk along with the library version they
+    belong to. Until the server confirms a version, cached pages are shown
+    at once and revalidated with their ETag; a newer version starts the
+    browsing over. Once known, pages of that version are used as cached.
+    """
 
     def __init__(self, *args, **kwargs):
         QAbstractItemModel.__init__(self, *args, **kwargs)
         self._rootIndex = QModelIndex()
         self._artists = SortedDict()
+        self._trackItems = {}
+
+        self._browsing = False
+        self._artistsFetched = 0
+        self._artistsTotal = 0
+        self._lastArtistKey = None
+
+        # responses of an earlier reset are dropped
+        self._generation = 0
+        self._pending = {}
+
+        # library version confirmed by the server, None until then
+        self._version = None
+        self._cache = None
 
     def columnCount(self, parent=QModelIndex()):
         return 1
@@ -194,6 +221,13 @@ class LibraryModel(QAbstractItemModel):
 
         return len(parentItem._children)
 
+    def hasChildren(self, parent=QModelIndex()):
+        parentItem = parent.internalPointer()
+        if parentItem is None:
+            return len(self._artists) > 0 or self.canFetchMore(parent)
+
+        return len(parentItem._children) > 0 or parentItem.canFetchMore()
+
     def data(self, index, role=Qt.DisplayRole):
         if role == Qt.DisplayRole or role == Qt.ToolTipRole:
             item = index.internalPointer()
@@ -236,166 +270,340 @@ class LibraryModel(QAbstractItemModel):
     def headIndex(self):
         return self.index(0, 0, self._rootIndex)
 
-    def getArtist(self, artist):
-        albumartistkey = ArtistItem.getKey(artist)
-
-        if albumartistkey in self._artists:
-            artistItem = self._artists[albumartistkey]
-        else:
-            artistItem = ArtistItem(artist)
-            artistItem.model = self
-            self._artists[albumartistkey] = artistItem
-
-        return albumartistkey, artistItem
-
-    def removeArtist(self, artist):
-        artist = ArtistItem.getKey(artist)
-
-        artistItem = self._artists[artist]
-        artistItem.model = None
-        artistItem.clear()
-        del self._artists[artist]
-
-    def loadData(self, libraryData):
-        self.beginResetModel()
-
+    def _clear(self, browsing):
         # clear library tree
         while self._artists:
             _, artistItem = self._artists.popitem()
             artistItem.clear()
 
-        # fill new
-        for hash_, meta in libraryData.iteritems():
-
-            albumartist = meta['albumartist']
-            artist = meta['artist']
-            album = (meta['year'], meta['album'])
-            track = (meta['discnumber'], meta['tracknumber'], meta['trackname'])
+        self._trackItems = {}
+        self._browsing = browsing
+        self._artistsFetched = 0
+        self._artistsTotal = None if browsing else 0
+        self._lastArtistKey = None
+        self._generation = self._generation + 1
+        self._pending = {}
 
-            if albumartist != artist:
-                track = track + (artist,)
-            else:
-                track = track + ('',)
+        gc.collect()
 
-            _albumArtistKey, artistItem = self.getArtist(albumartist)
+    def browse(self, version=None):
+        """Show the whole library, fetched from the server when expanded.
 
-            albumItem = artistItem.getAlbum(album)
+        `version` is the current library version, if known.
+        """
+        from txplayagui.settings import baseUrl
 
-            if track not in albumItem._children:
-                trackItem = TrackItem(track)
-                trackItem.hash = hash_
-                trackItem.length = meta['length']
-                trackItem._parent = albumItem
-                albumItem._children[track] = trackItem
+        self._cache = ResponseCache(baseUrl())
+        if version is not None:
+            self._setVersion(version)
 
-        variousArtist = self._artists.get('')
-        if variousArtist is not None:
-            # recheck album artists
-            for album, albumItem in variousArtist._children.items():
-                albumArtists = set(trackItem._data[3]
-                                   for track, trackItem in albumItem._children.iteritems())
-                if '' in albumArtists:
-                    albumArtists.remove('')
+        self.beginResetModel()
+        self._clear(browsing=True)
+        self.endResetModel()
 
-                if len(albumArtists) > 1:
-                    # album has multiple artists
-                    continue
+        self.fetchMore(self._rootIndex)
 
-                # album has one artist
-                newAlbumArtist = tuple(albumArtists)[0]
-                newAlbumItem = self.getArtist(newAlbumArtist)[1].getAlbum(album)
+    def canFetchMore(self, parent):
+        parentItem = parent.internalPointer()
+        if parentItem is None:
+            return self._artistsTotal is None or self._artistsFetched < self._artistsTotal
 
-                for track, trackItem in albumItem._children.items():
-                    newTrack = track[:-1] + ('',)
+        return parentItem.canFetchMore()
 
-                    if newTrack not in newAlbumItem._children:
-                        newTrackItem = TrackItem(newTrack)
-                        newTrackItem.hash = trackItem.hash
-                        newTrackItem.length = trackItem.length
-                        newTrackItem._parent = newAlbumItem
+    def fetchMore(self, parent):
+        from txplayagui.client import getArtists, getArtistAlbums, getAlbumTracks
 
-                        newAlbumItem._children[newTrack] = newTrackItem
+        if not self.canFetchMore(parent):
+            return
 
-                    albumItem.removeTrack(track)
+        parentItem = parent.internalPointer()
+        if parentItem is None:
+            offset = self._artistsFetched
+            cacheKey = 'artists/%d/%d' % (offset, BROWSE_PAGE_SIZE)
+            fetch = partial(getArtists, offset, BROWSE_PAGE_SIZE)
+        elif isinstance(parentItem, ArtistItem):
+            offset = parentItem.fetched
+            cacheKey = 'albums/%s/%d/%d' % (parentItem.id, offset, BROWSE_PAGE_SIZE)
+            fetch = partial(getArtistAlbums, parentItem.id, offset, BROWSE_PAGE_SIZE)
+        else:
+            offset = parentItem.fetched
+            cacheKey = 'tracks/%s/%d/%d' % (parentItem.id, offset, BROWSE_PAGE_SIZE)
+            fetch = partial(getAlbumTracks, parentItem.id, offset, BROWSE_PAGE_SIZE)
+
+        if cacheKey in self._pending:
+            return
+
+        etag, cached = self._cache.get(cacheKey)
+        if cached is not None:
+            if self._version is None or cached['version'] == self._version:
+                self._onPage(parentItem, cached)
+                if self._version is not None:
+                    return
+            else:
+                etag, cached = None, None
+
+        # the request is kept until answered, one per page at a time
+        request = fetch(etag=etag)
+        self._pending[cacheKey] = request
+        generation = self._generation
+
+        def onResponse(response):
+            if generation != self._generation:
+                return
+            del self._pending[cacheKey]
+
+            if response.statusCode == 304:
+                self._setVersion(cached['version'])
+                return
+
+            if response.statusCode != 200:
+                print 'Library browse error:', response.statusCode
+                return
+
+            data = json.loads(response.data)
+            if cached is None:
+                self._setVersion(data['version'])
+                self._cache.put(cacheKey, response.etag, response.data)
+                self._onPage(parentItem, data)
+
+            elif data['version'] != cached['version']:
+                # the library changed since the page was cached
+                self._cache.clear()
+                self._setVersion(data['version'])
+                self._cache.put(cacheKey, response.etag, response.data)
+                self.browse()
+
+        onHttpResponse(request, onResponse)
+
+    def _setVersion(self, version):
+        if self._version is not None and version != self._version:
+            # pages of earlier versions are not used again
+            self._cache.clear()
+        self._version = version
+
+    def _onPage(self, parentItem, data):
+        if parentItem is None:
+            self._artistsFetched = self._artistsFetched + len(data['artists'])
+            self._artistsTotal = data['total']
+
+            for artist in data['artists']:
+                artistItem = ArtistItem(artist['name'])
+                artistItem.id = artist['id']
+                artistItem.model = self
+                if artistItem.key not in self._artists:
+                    self._insertRow(None, artistItem.key, artistItem)
+                self._lastArtistKey = artistItem.key
+            return
+
+        parentItem.fetched = parentItem.fetched + len(data.get('albums', data.get('tracks')))
+        parentItem.total = data['total']
+
+        if isinstance(parentItem, ArtistItem):
+            for album in data['albums']:
+                albumKey = (album['year'], album['name'])
+                if parentItem.findAlbum(albumKey) is None:
+                    albumItem = AlbumItem(albumKey)
+                    albumItem.id = album['id']
+                    self._insertRow(parentItem, albumKey, albumItem)
 
-        # put one-track artists under various
-        for artist, artistItem in self._artists.items():
-            if artistItem == variousArtist or len(artistItem._children) > 1:
-                continue
-            album, albumItem = artistItem._children.items()[0]
-            if len(albumItem._children) > 1:
-                continue
+        else:
+            for meta in data['tracks']:
+                self._addTrackItem(parentItem, meta['trackId'], meta)
 
-            track, trackItem = albumItem._children.items()[0]
-            newTrack = track[:-1] + (artist,)
-            newAlbumItem = variousArtist.getAlbum(album)
+        if parentItem.total == 0:
+            # emptied since it was listed
+            self._removeEmpty(parentItem)
 
-            if newTrack not in newAlbumItem._children:
-                newTrackItem = TrackItem(newTrack)
-                newTrackItem.hash = trackItem.hash
-                newTrackItem.length = trackItem.length
-                newTrackItem._parent = newAlbumItem
+    def loadData(self, libraryData):
+        """Show the tracks of `libraryData`, {trackId: meta}."""
+        self.beginResetModel()
+        self._clear(browsing=False)
 
-                newAlbumItem._children[newTrack] = newTrackItem
+        for hash_, meta in libraryData.iteritems():
+            albumItem = self._getAlbum(meta)
+            if trackKey(meta) not in albumItem._children:
+                trackItem = TrackItem(trackKey(meta))
+                trackItem.hash = hash_
+                trackItem.length = meta['length']
+                trackItem._parent = albumItem
+                albumItem._children[trackItem._data] = trackItem
+                self._trackItems[hash_] = trackItem
 
-            albumItem.removeTrack(track)
+        for artistItem in self._artists.itervalues():
+            for albumItem in artistItem._children.itervalues():
+                albumItem.setComplete()
+            artistItem.setComplete()
 
-        gc.collect()
+        self._artistsFetched = self._artistsTotal = len(self._artists)
 
         self.endResetModel()
 
-    def albumHashes(self, index):
-        item = index.internalPointer()
-        if not isinstance(item, AlbumItem):
-            raise TypeError, 'Suplied index does not point to AlbumItem'
+    def _getAlbum(self, meta):
+        name = artistName(meta)
+        artistKey = ArtistItem.getKey(name)
+        artistItem = self._artists.get(artistKey)
+        if artistItem is None:
+            artistItem = ArtistItem(name)
+            artistItem.id = meta.get('artistId')
+            artistItem.model = self
+            self._artists[artistKey] = artistItem
 
-        return item.albumHashes()
+        album = (meta['year'], meta['album'])
+        albumItem = artistItem.findAlbum(album)
+        if albumItem is None:
+            albumItem = AlbumItem(album)
+            albumItem.id = meta.get('albumId')
+            albumItem._parent = artistItem
+            artistItem._children[album] = albumItem
 
-    def filter(self, query):
-        query = unidecode(query).lower()
-        filtered = ((artistKey, albumKey, albumItem, trackItem.row(), trackItem.match(query))
-                    for artistKey, artistItem in self._artists.iteritems()
-                    for albumKey, albumItem in artistItem._children.iteritems()
-                    for trackItem in albumItem._children.itervalues())
+        return albumItem
 
-        shownArtistKeys, shownAlbumKeys = set(), set()
+    def applyDelta(self, delta):
+        """Apply a LibraryChanged delta row by row, without a reset.
 
-        parentIndex = None
+        Only rows already shown change. New tracks are added under loaded
+        albums while browsing, the rest is fetched when expanded.
+        """
+        if 'version' in delta and self._cache is not None:
+            self._setVersion(delta['version'])
 
-        for artistKey, albumKey, albumItem, trackRow, isMatch in filtered:
-            parentIndex = self.createIndex(albumItem.row(), 0, albumItem)
-            self.toggleRow.emit(trackRow, parentIndex, isMatch)
+        for hash_ in delta['removed']:
+            self._removeTrack(hash_)
 
-            if isMatch:
-                shownArtistKeys.add(artistKey)
-                shownAlbumKeys.add(albumKey)
-        del parentIndex
+        for hash_, meta in delta['updated'].iteritems():
+            if self._removeTrack(hash_) or self._browsing:
+                self._addTrack(hash_, meta)
 
-        for artistKey, artistItem in self._artists.iteritems():
-            if artistKey not in shownArtistKeys:
-                # hide artist row
-                self.toggleRow.emit(artistItem.row(), self._rootIndex, False)
+        if not self._browsing:
+            return
 
-            else:
-                # show artist, filter albums
-                self.toggleRow.emit(artistItem.row(), self._rootIndex, True)
+        for hash_, meta in delta['added'].iteritems():
+            self._addTrack(hash_, meta)
 
-                for albumKey, albumItem in artistItem._children.iteritems():
-                    parentIndex = self.createIndex(artistItem.row(), 0, artistItem)
+    def _addTrack(self, hash_, meta):
+        name = artistName(meta)
+        artistKey = ArtistItem.getKey(name)
+        artistItem = self._artists.get(artistKey)
 
-                    if albumKey in shownAlbumKeys:
-                        self.toggleRow.emit(albumItem.row(), parentIndex, True)
-                    else:
-                        self.toggleRow.emit(albumItem.row(), parentIndex, False)
+        if artistItem is None:
+            if self.canFetchMore(self._rootIndex) and artistKey > self._lastArtistKey:
+                # comes with a later page
+                return
 
-    def showAll(self):
-        for artistItem in self._artists.itervalues():
-            self.toggleRow.emit(artistItem.row(), self._rootIndex, True)
-            artistIndex = self.createIndex(artistItem.row(), 0, artistItem)
+            artistItem = ArtistItem(name)
+            artistItem.id = meta.get('artistId')
+            artistItem.model = self
+            self._insertRow(None, artistKey, artistItem)
+            self._artistsFetched = self._artistsFetched + 1
+            self._artistsTotal = self._artistsTotal + 1
+            if self._browsing:
+                return
+            artistItem.setComplete()
+
+        if artistItem.canFetchMore():
+            return
+
+        album = (meta['year'], meta['album'])
+        albumItem = artistItem.findAlbum(album)
+        if albumItem is None:
+            albumItem = AlbumItem(album)
+            albumItem.id = meta.get('albumId')
+            self._insertRow(artistItem, album, albumItem)
+            artistItem.fetched = artistItem.fetched + 1
+            artistItem.total = artistItem.total + 1
+            if self._browsing:
+                return
+            albumItem.setComplete()
+
+        if albumItem.canFetchMore():
+            return
+
+        if self._addTrackItem(albumItem, hash_, meta):
+            albumItem.fetched = albumItem.fetched + 1
+            albumItem.total = albumItem.total + 1
+
+    def _addTrackItem(self, albumItem, hash_, meta):
+        track = trackKey(meta)
+        if track in albumItem._children:
+            return False
+
+        trackItem = TrackItem(track)
+        trackItem.hash = hash_
+        trackItem.length = meta['length']
+        self._insertRow(albumItem, track, trackItem)
+        self._trackItems[hash_] = trackItem
+        return True
+
+    def _removeTrack(self, hash_):
+        trackItem = self._trackItems.pop(hash_, None)
+        if trackItem is None:
+            return False
+
+        albumItem = trackItem.albumItem()
+        self._removeRow(albumItem, trackItem._data)
+        albumItem.fetched = albumItem.fetched - 1
+        albumItem.total = albumItem.total - 1
+
+        if albumItem.total == 0:
+            self._removeEmpty(albumItem)
+        return True
+
+    def _removeEmpty(self, item):
+        """Drop `item` and the parents it leaves empty."""
+        parentItem = item.parentItem()
+        if parentItem is None:
+            self._removeRow(None, item.key)
+            self._artistsFetched = self._artistsFetched - 1
+            self._artistsTotal = self._artistsTotal - 1
+            return
 
-            for albumItem in artistItem._children.itervalues():
-                self.toggleRow.emit(albumItem.row(), artistIndex, True)
-                albumIndex = self.createIndex(albumItem.row(), 0, albumItem)
+        self._removeRow(parentItem, item._data)
+        parentItem.fetched = parentItem.fetched - 1
+        parentItem.total = parentItem.total - 1
 
-                for trackItem in albumItem._children.itervalues():
-                    self.toggleRow.emit(trackItem.row(), albumIndex, True)
+        if parentItem.total == 0:
+            self._removeEmpty(parentItem)
+
+    def _parentOf(self, parentItem):
+        if parentItem is None:
+            return self._artists, self._rootIndex
+
+        parentIndex = self.createIndex(parentItem.row(), 0, parentItem)
+        return parentItem._children, parentIndex
+
+    def _insertRow(self, parentItem, key, item):
+        children, parentIndex = self._parentOf(parentItem)
+        if parentItem is not None:
+            item._parent = parentItem
+            parentItem.__dict__.pop('_discCount', None)
+
+        row = children.insertionIndex(key)
+        self.beginInsertRows(parentIndex, row, row)
+        children[key] = item
+        self.endInsertRows()
+
+    def _removeRow(self, parentItem, key):
+        children, parentIndex = self._parentOf(parentItem)
+        if parentItem is not None:
+            parentItem.__dict__.pop('_discCount', None)
+
+        row = children.index(key)
+        self.beginRemoveRows(parentIndex, row, row)
+        for hash_ in self._trackHashes(children[key]):
+            self._trackItems.pop(hash_, None)
+        children[key].clear()
+        del children[key]
+        self.endRemoveRows()
+
+    def _trackHashes(self, item):
+        if isinstance(item, TrackItem):
+            return [item.hash]
+        return [hash_ for child in item._children.itervalues()
+                for hash_ in self._trackHashes(child)]
+
+    def albumHashes(self, index):
+        item = index.internalPointer()
+        if not isinstance(item, AlbumItem):
+            raise TypeError, 'Suplied index does not point to AlbumItem'
+
+        return item.albumHashes()
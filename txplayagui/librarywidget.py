@@ -5,8 +5,11 @@ from PyQt5.QtWidgets import QWidget, QSpacerItem, QSizePolicy, QShortcut
 from PyQt5.QtGui import QKeySequence
 
 from txplayagui.ui.library import Ui_LibraryWidget
-from txplayagui.library import LibraryModel
-from txplayagui.utilities import unwrapMime
+from txplayagui.library import LibraryModel, AlbumItem, TrackItem
+from txplayagui.utilities import onHttpResponse
+
+# search results and album tracks asked for at most
+RESULTS_LIMIT = 500
 
 
 class LibraryWidget(Ui_LibraryWidget, QWidget):
@@ -24,7 +27,9 @@ class LibraryWidget(Ui_LibraryWidget, QWidget):
         self.libraryModel = LibraryModel()
         self.treeView.setModel(self.libraryModel)
 
-        self.libraryModel.toggleRow.connect(self.onToggleRow)
+        self._searchQuery = None
+        self._scanning = False
+        self.scanResponse = None
         self.rescanButton.clicked.connect(self.rescanClicked)
         self.treeView.doubleClicked.connect(self.onTreeViewDoubleClicked)
 
@@ -46,9 +51,7 @@ class LibraryWidget(Ui_LibraryWidget, QWidget):
     def rescanClicked(self):
         from txplayagui.client import rescanLibrary
 
-        self.rescanButton.hide()
-        self.scanControlsLayout.removeItem(self.scanControlsLayout.itemAt(2))
-        self.scanProgressBar.show()
+        self._showScanProgress()
 
         self.scanResponse = rescanLibrary()
         self.scanResponse.lineReceived.connect(self.scanProgress)
@@ -64,27 +67,67 @@ class LibraryWidget(Ui_LibraryWidget, QWidget):
         else:
             self.scanResponse.close()
             self.scanResponse.deleteLater()
+            self.scanResponse = None
 
-            self.rescanFinished(data['library'])
+            self.rescanFinished(data.get('version'))
 
-    @pyqtSlot(int, QModelIndex, bool)
-    def onToggleRow(self, row, parentIndex, isShown):
-        self.treeView.setRowHidden(row, parentIndex, not isShown)
+    @pyqtSlot(object)
+    def scanEvent(self, data):
+        """Progress of a rescan, also of one another client started."""
+        self._showScanProgress()
+        self.setProgress(data.get('progress', 0))
 
-    @pyqtSlot(QModelIndex)
-    def onTreeViewDoubleClicked(self, index):
-        hashes = self._getHashes(index)
-        if len(hashes) == 0:
+    @pyqtSlot(object)
+    def scanEnded(self, data):
+        # rescans of this client end with their response
+        if self._scanning and self.scanResponse is None:
+            self.rescanFinished(data.get('version'))
+
+    def _showScanProgress(self):
+        if self._scanning:
             return
 
-        self.itemsActivated.emit(hashes)
+        self._scanning = True
+        self.rescanButton.hide()
+        self.scanControlsLayout.removeItem(self.scanControlsLayout.itemAt(2))
+        self.scanProgressBar.show()
+
+    @pyqtSlot(QModelIndex)
+    def onTreeViewDoubleClicked(self, index):
+        self._activate([index])
 
     @pyqtSlot(unicode)
     def onQueryChanged(self, query):
         if len(query) > 2:
-            self.libraryModel.filter(query)
-        elif query == '':
-            return self.libraryModel.showAll()
+            self.search(query)
+        elif query == '' and self._searchQuery is not None:
+            self._searchQuery = None
+            self.libraryModel.browse()
+
+    def search(self, query):
+        """Show the tracks matching `query`, found by the server."""
+        from txplayagui.client import searchLibrary
+
+        self._searchQuery = query
+
+        def onResults(response):
+            if query != self._searchQuery:
+                # typed further meanwhile
+                return
+
+            data = json.loads(response.data)
+            self.libraryModel.loadData(dict((meta['trackId'], meta)
+                                            for meta in data['results']))
+
+        onHttpResponse(searchLibrary(query, limit=RESULTS_LIMIT), onResults)
+
+    def reload(self, version=None):
+        query = self.querySearchBox.text()
+        if len(query) > 2:
+            self.search(query)
+        else:
+            self._searchQuery = None
+            self.libraryModel.browse(version)
 
     @pyqtSlot()
     def onQueryClear(self):
@@ -99,10 +142,25 @@ class LibraryWidget(Ui_LibraryWidget, QWidget):
         self.treeView.setFocus()
 
     def onActivateTracks(self):
+        self._activate(self.treeView.selectedIndexes())
+
+    def _activate(self, indexes):
+        """Emit the tracks of `indexes`, albums not yet fetched follow later."""
         collectedHashes = []
 
-        for index in self.treeView.selectedIndexes():
-            for hash_ in self._getHashes(index):
+        for index in indexes:
+            item = index.internalPointer()
+            if isinstance(item, TrackItem):
+                hashes = [item.hash]
+            elif isinstance(item, AlbumItem) and item.canFetchMore():
+                self._activateAlbum(item.id)
+                continue
+            elif isinstance(item, AlbumItem):
+                hashes = self.libraryModel.albumHashes(index)
+            else:
+                continue
+
+            for hash_ in hashes:
                 if hash_ not in collectedHashes:
                     collectedHashes.append(hash_)
 
@@ -111,29 +169,26 @@ class LibraryWidget(Ui_LibraryWidget, QWidget):
 
         self.itemsActivated.emit(collectedHashes)
 
-    def _getHashes(self, index):
-        mimeData = unwrapMime(self.libraryModel.mimeData([index]))
-        item = mimeData['items'][0]
-        try:
-            return [item['hash']]
-        except KeyError:
-            if 'album' in item:
-                return self.libraryModel.albumHashes(index)
-        return []
+    def _activateAlbum(self, albumId):
+        from txplayagui.client import getAlbumTracks
+
+        def onTracks(response):
+            data = json.loads(response.data)
+            hashes = [meta['trackId'] for meta in data['tracks']]
+            if len(hashes) > 0:
+                self.itemsActivated.emit(hashes)
+
+        onHttpResponse(getAlbumTracks(albumId, limit=RESULTS_LIMIT), onTracks)
 
     def setProgress(self, value):
         self.scanProgressBar.setValue(value)
 
-    def rescanFinished(self, data):
-        self.libraryModel.loadData(data)
-
+    def rescanFinished(self, version=None):
+        self._scanning = False
         self.rescanButton.show()
         spacerItem = QSpacerItem(0, 0, QSizePolicy.Expanding, QSizePolicy.Minimum)
         self.scanControlsLayout.addItem(spacerItem)
         self.scanProgressBar.hide()
         self.scanProgressBar.setValue(0)
 
-        # apply filter if active
-        query = self.querySearchBox.text().lower()
-        if len(query) > 2:
-            self.libraryModel.filter(query)
+        self.reload(version)
@@ -15,14 +15,14 @@ class Track(object):
     @classmethod
     def fromData(cls, data):
         track = Track()
-        track.id3 = {'Album': data['album'],
-                     'Title': data['trackname'],
-                     'Artist': data['artist'],
-                     'AlbumArtist': data['albumartist'],
-                     'Year': data['year'],
-                     'TrackNumber': data['tracknumber']}
-
-        track.length = data['length']
+        track.id3 = {'Album': data.get('album', u''),
+                     'Title': data.get('trackname', u''),
+                     'Artist': data.get('artist', u''),
+                     'AlbumArtist': data.get('albumartist', u''),
+                     'Year': data.get('year'),
+                     'TrackNumber': data.get('tracknumber')}
+
+        track.length = data.get('length') or 0
         sec = track.length
         min_ = int(floor(sec/60))
         sec = int(ceil(sec - min_ * 60))
@@ -69,6 +69,8 @@ class PlaylistModel(QAbstractTableModel):
     currentPosition = None
     hasUndo = False
     hasRedo = False
+    version = None
+    epoch = None
 
     trackInserted = pyqtSignal(int, Track)
     trackRemoved = pyqtSignal(int)
@@ -99,18 +101,71 @@ class PlaylistModel(QAbstractTableModel):
         return Qt.ItemIsSelectable | Qt.ItemIsDragEnabled | Qt.ItemIsDropEnabled \
                | Qt.ItemIsEnabled
 
-    def updateAll(self, playlistData):
+    def updateAll(self, playlistData, version=None, epoch=None):
         self.beginResetModel()
-        self._tracks = []
-        for trackData in playlistData:
-            try:
-                track = Track.fromData(trackData)
-            except KeyError:
-                pass
-            else:
-                self._tracks.append(track)
+        self._tracks = [Track.fromData(trackData) for trackData in playlistData]
+        self.version = version
+        self.epoch = epoch
         self.endResetModel()
 
+    def resetVersion(self):
+        """Forget the version, the next snapshot is applied whatever it is."""
+        self.version = None
+        self.epoch = None
+
+    def isStale(self, version, epoch):
+        """Whether the model already holds a version past `version`."""
+        return epoch == self.epoch and self.version is not None \
+            and version is not None and version < self.version
+
+    def applyDelta(self, base, version, ops, epoch=None):
+        """Apply the changes turning playlist `base` into `version`.
+
+        Returns False when the model is not at `base` of the same `epoch`
+        and needs a snapshot. Deltas the model is already past are ignored.
+        """
+        if epoch != self.epoch:
+            # the server restarted, its versions count from scratch
+            return False
+        if self.version is not None and version <= self.version:
+            return True
+        if base != self.version:
+            return False
+
+        root = QModelIndex()
+        for op in ops:
+            kind = op[0]
+
+            if kind == 'insert':
+                position, tracks = op[1], [Track.fromData(trackData) for trackData in op[2]]
+                self.beginInsertRows(root, position, position + len(tracks) - 1)
+                self._tracks[position:position] = tracks
+                self.endInsertRows()
+
+            elif kind == 'remove':
+                position, count = op[1], op[2]
+                self.beginRemoveRows(root, position, position + count - 1)
+                del self._tracks[position:position + count]
+                self.endRemoveRows()
+
+            elif kind == 'move':
+                origin, target = op[1], op[2]
+                if origin == target:
+                    continue
+                # destination is given in row numbers before the move
+                destination = target + 1 if target > origin else target
+                self.beginMoveRows(root, origin, origin, root, destination)
+                self._tracks.insert(target, self._tracks.pop(origin))
+                self.endMoveRows()
+
+            else:
+                self.beginResetModel()
+                self._tracks = []
+                self.endResetModel()
+
+        self.version = version
+        return True
+
     def mimeData(self, indexes):
         return mimeWrapJson({'source': 'playlist',
                              'row': indexes[0].row()})
@@ -121,9 +176,11 @@ class PlaylistModel(QAbstractTableModel):
         return QAbstractTableModel.headerData(self, section, orientation, role)
 
     def setPlayingPosition(self, position):
-        self.beginResetModel()
-        self.currentPosition = position
-        self.endResetModel()
+        previous, self.currentPosition = self.currentPosition, position
+        for row in (previous, position):
+            if row is not None and row < len(self._tracks):
+                self.dataChanged.emit(self.index(row, 0),
+                                      self.index(row, self.columnCount() - 1))
 
     def isPlaying(self, index):
         return index.row() == self.currentPosition
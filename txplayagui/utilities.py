@@ -1,3 +1,4 @@
+from bisect import bisect_left, insort
 import json
 
 from PyQt5.QtCore import QMimeData
@@ -27,10 +28,10 @@ class SortedDict(dict):
         self._orderedKeys = sorted(self.keys())
 
     def __setitem__(self, key, val):
-        resort = (key not in self)
+        isNew = (key not in self)
         dict.__setitem__(self, key, val)
-        if resort:
-            self._orderedKeys = sorted(self.keys())
+        if isNew:
+            insort(self._orderedKeys, key)
 
     def __delitem__(self, key):
         dict.__delitem__(self, key)
@@ -48,6 +49,10 @@ class SortedDict(dict):
     def index(self, key):
         return self._orderedKeys.index(key)
 
+    def insertionIndex(self, key):
+        """Position `key` takes once set."""
+        return bisect_left(self._orderedKeys, key)
+
     def clear(self, *args, **kwargs):
         dict.clear(self, *args, **kwargs)
         self._orderedKeys[:] = []